@@ -0,0 +1,445 @@
+#===============================================================================
+#
+# Timing and resource accounting for build actions
+#
+# $Id$
+#
+#===============================================================================
+
+"""
+Records start/end time, CPU time and maximum resident memory of every
+action executed by SCons and writes them, one JSON object per line, into
+a log file (build/$SIT_ARCH/action_stats.jsonl). Enabled with ACTION_STATS=1.
+
+Command actions are timed by a replacement SPAWN function which waits for
+the child process with os.wait4() to get its resource usage; the target
+of the command is passed to it through the ENV of the command by a shell
+environment generator (needs SCons 4.4 or later, earlier versions log the
+command without the target). Python-function actions of SConsTools are
+timed by wrapping them with timedAction(), processes which they start
+should be run with call() to be accounted for.
+
+The log is re-created by every build which executes any action, the
+BuildReport action summarizes it and CriticalPathReport finds the longest
+chain of actions in it. LinkReport keeps link times of the builds made with
+different linker options so that they can be compared.
+"""
+from __future__ import print_function
+
+import os
+import json
+import time
+import atexit
+import threading
+import subprocess
+
+_TARGET_VAR = '_SIT_ACTION_TARGET'
+_BUILDER_VAR = '_SIT_ACTION_BUILDER'
+
+_logName = None
+_log = None
+_lock = threading.Lock()
+_current = threading.local()
+
+if hasattr(time, 'thread_time'):
+    _threadCpu = time.thread_time
+else:
+    _threadCpu = None
+
+
+def _write(rec):
+    """Append one record to the log, log file is opened on first record"""
+    global _log
+    line = json.dumps(rec, sort_keys=True) + '\n'
+    with _lock:
+        if _log is None:
+            d = os.path.dirname(_logName)
+            if d and not os.path.isdir(d): os.makedirs(d)
+            _log = open(_logName, 'w')
+            atexit.register(_log.close)
+        _log.write(line)
+        _log.flush()
+
+
+def _builderName(target, env):
+    try:
+        return target.get_builder().get_name(env)
+    except Exception:
+        return '?'
+
+
+def _status(status):
+    """Convert wait status to exit code, negative signal number for killed processes"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _run(args, **kw):
+    """Run process, returns (exit code, resource usage) of the child process"""
+    proc = subprocess.Popen(args, **kw)
+    try:
+        pid, status, ru = os.wait4(proc.pid, 0)
+    except:
+        proc.kill()
+        proc.wait()
+        raise
+    proc.returncode = _status(status)
+    return proc.returncode, ru
+
+
+def _actionEnv(env, target, source, ENV):
+    """Shell environment generator which passes the target to the spawn function"""
+    if _logName is not None and target:
+        ENV[_TARGET_VAR] = str(target[0])
+        ENV[_BUILDER_VAR] = _builderName(target[0], env)
+    return ENV
+
+
+def _makeSpawn(spawn):
+    """Returns SPAWN function which times the commands"""
+
+    def _spawn(sh, escape, cmd, args, env):
+
+        target = env.get(_TARGET_VAR, '?')
+        builder = env.get(_BUILDER_VAR, '?')
+        env = dict((k, v) for k, v in env.items() if k not in (_TARGET_VAR, _BUILDER_VAR))
+
+        start = time.time()
+        # other SPAWN replacements (e.g. compile workers) have to be called
+        if hasattr(os, 'wait4') and not getattr(spawn, 'delegate', False):
+            rc, ru = _run([sh, '-c', ' '.join(args)], env=env, close_fds=True)
+            usage = dict(cpu_user=ru.ru_utime, cpu_sys=ru.ru_stime, maxrss_kb=ru.ru_maxrss)
+        else:
+            rc = spawn(sh, escape, cmd, args, env)
+            usage = {}
+        end = time.time()
+
+        rec = dict(target=target, builder=builder, kind='command', command=' '.join(args),
+                   start=start, end=end, wall=end-start, status=rc)
+        rec.update(usage)
+        _write(rec)
+        return rc
+
+    return _spawn
+
+
+class _TimedFunction(object):
+    """Wrapper for Python-function actions which records their time"""
+
+    def __init__(self, func):
+        self._func = func
+        self.__name__ = getattr(func, '__name__', func.__class__.__name__)
+        # SCons computes action signature from __func__, keep signature
+        # of the wrapped function so that enabling stats does not rebuild
+        self.__func__ = getattr(func.__call__, '__func__', func)
+        if hasattr(func, 'strfunction'):
+            self.strfunction = func.strfunction
+
+    def __call__(self, target, source, env):
+
+        rec = dict(target=str(target[0]) if target else '?', builder=_builderName(target[0], env) if target else '?',
+                   kind='function', function=self.__name__, cpu_user=0., cpu_sys=0., maxrss_kb=0)
+        _current.rec = rec
+        cpu = _threadCpu() if _threadCpu else None
+        rec['start'] = time.time()
+        try:
+            res = self._func(target=target, source=source, env=env)
+            rec['status'] = 1 if res else 0
+            return res
+        except:
+            rec['status'] = 1
+            raise
+        finally:
+            rec['end'] = time.time()
+            rec['wall'] = rec['end'] - rec['start']
+            if cpu is not None: rec['cpu_user'] += _threadCpu() - cpu
+            _current.rec = None
+            _write(rec)
+
+
+def timedAction(env, func):
+    """Returns function action which is timed if ACTION_STATS is enabled, otherwise function itself"""
+    if env.get('ACTION_STATS'):
+        return _TimedFunction(func)
+    return func
+
+
+def call(cmd, shell=False):
+    """
+    Run command and return its exit code, like subprocess.call(). Resource
+    usage of the process is added to the action which is being executed.
+    """
+    if not hasattr(os, 'wait4'):
+        return subprocess.call(cmd, shell=shell)
+    rc, ru = _run(cmd, shell=shell)
+    rec = getattr(_current, 'rec', None)
+    if rec is not None:
+        rec['cpu_user'] += ru.ru_utime
+        rec['cpu_sys'] += ru.ru_stime
+        rec['maxrss_kb'] = max(rec['maxrss_kb'], ru.ru_maxrss)
+    return rc
+
+
+def enableActionStats(env, fileName):
+    """Install timed SPAWN in the environment, records go to fileName"""
+    global _logName
+    _logName = fileName
+    env['SPAWN'] = _makeSpawn(env['SPAWN'])
+    env.Append(SHELL_ENV_GENERATORS=[_actionEnv])
+
+
+def readActionStats(fileName):
+    """Returns list of records from the log file"""
+    recs = []
+    f = open(fileName)
+    for line in f:
+        try:
+            recs.append(json.loads(line))
+        except ValueError:
+            # last line may be incomplete if build was interrupted
+            pass
+    f.close()
+    return recs
+
+
+def targetPackage(rec, sit_arch):
+    """Guess package name from the target path of the record"""
+    parts = os.path.normpath(rec['target']).split(os.sep)
+    if len(parts) > 3 and parts[0] == 'build' and parts[1] == sit_arch:
+        return parts[2]
+    if len(parts) > 4 and parts[0] == 'arch' and parts[2] in ('python', 'geninc'):
+        return parts[3]
+    if len(parts) > 2 and parts[0] in ('include', 'data', 'web'):
+        return parts[1]
+    if len(parts) > 3 and parts[0] == 'arch' and parts[2] in ('lib', 'bin'):
+        # installed binaries and libraries, package is not known from the path
+        return '<installed>'
+    return '<release>'
+
+
+class BuildReport(object):
+    """Action which prints summary of the action log of the last build"""
+
+    # output is the report itself
+    strfunction = None
+
+    def __init__(self, fileName, top=10):
+        self.fileName = fileName
+        self.top = top
+
+    def __call__(self, target, source, env):
+
+        if not os.path.isfile(self.fileName):
+            print("No action statistics in %s, run build with ACTION_STATS=1 first" % self.fileName)
+            return
+
+        recs = readActionStats(self.fileName)
+        if not recs:
+            print("No actions recorded in %s" % self.fileName)
+            return
+
+        start = min(r['start'] for r in recs)
+        end = max(r['end'] for r in recs)
+        total = sum(r['wall'] for r in recs)
+        print("Action statistics from %s" % self.fileName)
+        print("%d actions, %.1f sec elapsed, %.1f sec total action time" % (len(recs), end - start, total))
+
+        def cpu(r):
+            return r.get('cpu_user', 0.) + r.get('cpu_sys', 0.)
+
+        print("\nSlowest targets:")
+        print("  %8s %8s %9s  %-16s %s" % ("wall,s", "cpu,s", "rss,MB", "builder", "target"))
+        for r in sorted(recs, key=lambda r: -r['wall'])[:self.top]:
+            print("  %8.2f %8.2f %9.1f  %-16s %s" % (r['wall'], cpu(r), r.get('maxrss_kb', 0)/1024., r['builder'], r['target']))
+
+        for title, key in [("builder", lambda r: r['builder']),
+                           ("package", lambda r: targetPackage(r, env['SIT_ARCH']))]:
+            groups = {}
+            for r in recs:
+                groups.setdefault(key(r), []).append(r)
+            print("\nPer %s:" % title)
+            print("  %8s %8s %6s  %-24s %s" % ("wall,s", "cpu,s", "count", title, "slowest target"))
+            for name, grp in sorted(groups.items(), key=lambda x: -sum(r['wall'] for r in x[1]))[:self.top]:
+                slowest = max(grp, key=lambda r: r['wall'])
+                print("  %8.2f %8.2f %6d  %-24s %s (%.2f s)" % (sum(r['wall'] for r in grp), sum(cpu(r) for r in grp),
+                                                          len(grp), name, slowest['target'], slowest['wall']))
+
+
+def criticalPath(recs, lookup):
+    """
+    Finds the longest chain of actions through the dependency graph.
+    recs are the records from the action log, lookup(path) returns SCons
+    node for the target path. Returns (total time of the path, list of
+    (node, record) along the path starting from the final target).
+    """
+
+    weight = {}
+    rec4node = {}
+    for r in recs:
+        node = lookup(r['target'])
+        weight[node] = weight.get(node, 0.) + r['wall']
+        rec4node[node] = r
+
+    # longest path ending at each node, iterative depth-first walk
+    dist = {}
+    nextNode = {}
+    for root in weight:
+        stack = [(root, iter(root.children()))]
+        onstack = set([root])
+        while stack:
+            node, children = stack[-1]
+            for child in children:
+                if child not in dist and child not in onstack:
+                    stack.append((child, iter(child.children())))
+                    onstack.add(child)
+                    break
+            else:
+                stack.pop()
+                onstack.discard(node)
+                best, bestChild = 0., None
+                for child in node.children():
+                    if dist.get(child, 0.) > best:
+                        best, bestChild = dist[child], child
+                dist[node] = weight.get(node, 0.) + best
+                nextNode[node] = bestChild
+
+    if not dist:
+        return 0., []
+    node = max(weight, key=lambda n: dist[n])
+    length = dist[node]
+    path = []
+    while node is not None:
+        if node in rec4node: path.append((node, rec4node[node]))
+        node = nextNode.get(node)
+    return length, path
+
+
+class CriticalPathReport(object):
+    """Action which prints critical path of the last build and bounds on parallel speedup"""
+
+    # output is the report itself
+    strfunction = None
+
+    def __init__(self, fileName, jobs=(1, 2, 4, 8, 16, 32, 64)):
+        self.fileName = fileName
+        self.jobs = jobs
+
+    def __call__(self, target, source, env):
+
+        if not os.path.isfile(self.fileName):
+            print("No action statistics in %s, run build with ACTION_STATS=1 first" % self.fileName)
+            return
+        recs = readActionStats(self.fileName)
+        if not recs:
+            print("No actions recorded in %s" % self.fileName)
+            return
+
+        length, path = criticalPath(recs, env.fs.Entry)
+
+        work = sum(r['wall'] for r in recs)
+        elapsed = max(r['end'] for r in recs) - min(r['start'] for r in recs)
+        print("Critical path of the build in %s" % self.fileName)
+        print("%d actions, total work %.1f sec, elapsed %.1f sec, critical path %.1f sec (%d actions)" %
+              (len(recs), work, elapsed, length, len(path)))
+
+        print("\nCritical path, final target first:")
+        print("  %8s  %-16s %-24s %s" % ("wall,s", "builder", "package", "target"))
+        for node, r in path:
+            print("  %8.2f  %-16s %-24s %s" % (r['wall'], r['builder'], targetPackage(r, env['SIT_ARCH']), r['target']))
+
+        pkgs = {}
+        for node, r in path:
+            pkg = targetPackage(r, env['SIT_ARCH'])
+            pkgs[pkg] = pkgs.get(pkg, 0.) + r['wall']
+        print("\nCritical path per package:")
+        for pkg, t in sorted(pkgs.items(), key=lambda x: -x[1]):
+            print("  %8.2f  %5.1f%%  %s" % (t, 100.*t/length if length else 0., pkg))
+
+        # Work-span bounds: with j workers time is at least max(work/j, span)
+        # and, for a greedy scheduler, at most work/j + span (Brent)
+        print("\nSpeedup bounds (work %.1f s, span %.1f s, parallelism %.1f):" %
+              (work, length, work/length if length else 0.))
+        print("  %5s %10s %10s %9s %9s" % ("-j", "min time", "max time", "min spdup", "max spdup"))
+        jobs = sorted(set(list(self.jobs) + [env.GetOption('num_jobs')]))
+        for j in jobs:
+            tmin = max(work/j, length)
+            tmax = work/j + length
+            print("  %5d %10.1f %10.1f %9.2f %9.2f" % (j, tmin, tmax, work/tmax if tmax else 0., work/tmin if tmin else 0.))
+
+
+# builders which run the linker
+_linkBuilders = ('SharedLibrary', 'Program', 'LoadableModule', 'PythonExtension')
+
+def linkStrategy(command):
+    """Describe linker options used by the link command"""
+    words = command.split()
+    strategy = ['ld']
+    for w in words:
+        if w.startswith('-fuse-ld='): strategy[0] = w.split('=', 1)[1]
+    for flag, name in [('--gdb-index', 'gdb-index'), ('--incremental', 'incremental'), ('-O0', 'O0')]:
+        if any(w.endswith(flag) for w in words): strategy.append(name)
+    return '+'.join(strategy)
+
+
+class LinkReport(object):
+    """
+    Action which adds link times of the last build to the history of link
+    times per linker strategy and prints the history
+    """
+
+    # output is the report itself
+    strfunction = None
+
+    def __init__(self, fileName, historyName):
+        self.fileName = fileName
+        self.historyName = historyName
+
+    def _kind(self, node, rec):
+        if rec['builder'] == 'SharedLibrary': return 'lib'
+        if rec['builder'] != 'Program': return 'pyext'
+        for src in node.sources:
+            if 'test' in os.path.normpath(str(src.srcnode())).split(os.sep): return 'test'
+        return 'app'
+
+    def __call__(self, target, source, env):
+
+        history = {}
+        if os.path.isfile(self.historyName):
+            f = open(self.historyName)
+            history = json.load(f)
+            f.close()
+
+        recs = []
+        if os.path.isfile(self.fileName):
+            recs = [r for r in readActionStats(self.fileName) if r['builder'] in _linkBuilders and 'command' in r]
+        if recs:
+            # strategies of the last build, normally there is one
+            for r in recs:
+                r['strategy'] = linkStrategy(r['command'])
+                r['kind'] = self._kind(env.fs.Entry(r['target']), r)
+            for strategy in set(r['strategy'] for r in recs):
+                stat = {}
+                for r in recs:
+                    if r['strategy'] != strategy: continue
+                    s = stat.setdefault(r['kind'], dict(count=0, wall=0., maxrss_kb=0))
+                    s['count'] += 1
+                    s['wall'] += r['wall']
+                    s['maxrss_kb'] = max(s['maxrss_kb'], r.get('maxrss_kb', 0))
+                history[strategy] = dict(time=min(r['start'] for r in recs), kinds=stat)
+            d = os.path.dirname(self.historyName)
+            if d and not os.path.isdir(d): os.makedirs(d)
+            f = open(self.historyName, 'w')
+            json.dump(history, f, indent=1, sort_keys=True)
+            f.close()
+        elif not history:
+            print("No link actions in %s, run build with ACTION_STATS=1 first" % self.fileName)
+            return
+
+        print("Link times per linker strategy (from %s):" % self.historyName)
+        print("  %-32s %-19s %6s %6s %9s %9s %9s" % ("strategy", "recorded", "kind", "count", "total,s", "mean,s", "rss,MB"))
+        for strategy, h in sorted(history.items()):
+            when = time.strftime("%Y-%m-%d %H:%M", time.localtime(h['time']))
+            for kind, s in sorted(h['kinds'].items()):
+                print("  %-32s %-19s %6s %6d %9.2f %9.3f %9.1f" % (strategy, when, kind, s['count'], s['wall'],
+                                                                s['wall']/s['count'], s['maxrss_kb']/1024.))
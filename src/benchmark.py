@@ -0,0 +1,489 @@
+#===============================================================================
+#
+# Synthetic releases and scaling benchmark for SConsTools
+#
+# $Id$
+#
+#===============================================================================
+
+"""
+Generates synthetic SIT releases and measures how long SCons takes to
+process them. Every generated package has a standard SConscript and a
+configurable number of library sources, applications, tests, python
+modules and extension modules. Packages include headers of other packages
+so that the include graph (and hence the package dependency graph) has
+a controllable depth and fan-out. Optionally a base release is generated
+too and used through SIT_REPOS.
+
+Builds are run with PROFILE=1 and the phase times are taken from the
+profile that SConstruct.main writes.
+
+This script does not need SCons, it runs scons as a separate process.
+Examples:
+
+    # generate release with 200 packages in /tmp/rel200
+    benchmark.py generate -n 200 /tmp/rel200
+
+    # measure scaling, results in scaling.json
+    benchmark.py scale -n 50,200,1000 -o scaling.json /tmp/bench
+
+    # check for regressions against stored baseline, exits with 1 if any
+    benchmark.py regress --baseline noop-baseline.json /tmp/bench
+
+    # check that build commands and no-op builds do not depend on
+    # PYTHONHASHSEED (other subcommands always use PYTHONHASHSEED=0)
+    benchmark.py determinism -n 100 /tmp/bench
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import difflib
+import shutil
+import random
+import argparse
+import subprocess
+
+# location of SConsTools package which is benchmarked
+_sconsTools = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _write(path, data):
+    d = os.path.dirname(path)
+    if d and not os.path.isdir(d): os.makedirs(d)
+    f = open(path, 'w')
+    f.write(data)
+    f.close()
+
+
+class ReleaseGenerator(object):
+    """
+    Generates synthetic release. Packages are split into `depth` levels,
+    headers of each package include `fanout` headers from packages of the
+    previous level (or from the base release for the first level).
+    """
+
+    def __init__(self, npkgs, depth=5, fanout=3, headers=3, srcs=2, apps=1, tests=0,
+                 pymods=0, pyext=0, prefix="Pkg", seed=12345):
+        self.npkgs = npkgs
+        self.depth = max(1, min(depth, npkgs))
+        self.fanout = fanout
+        self.headers = max(1, headers)
+        self.srcs = srcs
+        self.apps = apps
+        self.tests = tests
+        self.pymods = pymods
+        self.pyext = pyext
+        self.prefix = prefix
+        self.seed = seed
+
+    def packages(self):
+        return ["%s%04d" % (self.prefix, i) for i in range(self.npkgs)]
+
+    def levels(self):
+        """List of package lists, one list per level"""
+        levels = [[] for i in range(self.depth)]
+        for i, pkg in enumerate(self.packages()):
+            levels[i * self.depth // self.npkgs].append(pkg)
+        return levels
+
+    def generate(self, reldir, relname, condaPrefix, sitArch, base=None):
+        """
+        Make release directory. `base` is a generator of the base release
+        whose headers are included by the first level of packages.
+        """
+
+        rnd = random.Random(self.seed)
+
+        if not os.path.isdir(reldir): os.makedirs(reldir)
+        _write(os.path.join(reldir, ".sit_release"), relname + "\n")
+        _write(os.path.join(reldir, ".sit_conda_env"), condaPrefix + "\n")
+        for link, dst in [("SConsTools", _sconsTools), ("SConstruct", os.path.join("SConsTools", "src", "SConstruct.main"))]:
+            link = os.path.join(reldir, link)
+            if os.path.islink(link): os.remove(link)
+            os.symlink(dst, link)
+
+        prev = base.levels()[-1] if base is not None else []
+        prevHeaders = base.headers if base is not None else 0
+        for level in self.levels():
+            for pkg in level:
+                deps = rnd.sample(prev, min(self.fanout, len(prev)))
+                self._package(os.path.join(reldir, pkg), pkg, deps, prevHeaders, rnd)
+            prev = level
+            prevHeaders = self.headers
+
+    def _package(self, pkgdir, pkg, deps, depHeaders, rnd):
+
+        _write(os.path.join(pkgdir, "SConscript"), "Import('*')\nstandardSConscript()\n")
+
+        # headers, first header includes headers of dependencies, others include the first one
+        for h in range(self.headers):
+            lines = ["#ifndef %s_HDR%d_H" % (pkg.upper(), h), "#define %s_HDR%d_H" % (pkg.upper(), h)]
+            if h == 0:
+                for dep in deps:
+                    lines.append('#include "%s/hdr%d.h"' % (dep, rnd.randrange(depHeaders)))
+            else:
+                lines.append('#include "%s/hdr0.h"' % pkg)
+            lines += ["int %s_f%d();" % (pkg, h), "#endif"]
+            _write(os.path.join(pkgdir, "include", "hdr%d.h" % h), '\n'.join(lines) + '\n')
+
+        # library, every header function is defined in some source file
+        funcs = ["%s_f%d" % (pkg, h) for h in range(self.headers)]
+        if self.srcs:
+            for s in range(self.srcs):
+                lines = ['#include "%s/hdr%d.h"' % (pkg, h) for h in range(s, self.headers, self.srcs)]
+                lines += ["int %s() { return %d; }" % (funcs[h], h) for h in range(s, self.headers, self.srcs)]
+                lines += ["int %s_src%d() { return %d; }" % (pkg, s, s)]
+                _write(os.path.join(pkgdir, "src", "src%d.cpp" % s), '\n'.join(lines) + '\n')
+
+        # applications and tests call one function from the library
+        call = funcs[0] if self.srcs else None
+        for subdir, name, count in [("app", "app", self.apps), ("test", "test", self.tests)]:
+            for a in range(count):
+                lines = ['#include "%s/hdr0.h"' % pkg]
+                if call:
+                    lines.append("int main() { return %s() != 0; }" % call)
+                else:
+                    lines.append("int main() { return 0; }")
+                _write(os.path.join(pkgdir, subdir, "%s_%s%d.cpp" % (pkg.lower(), name, a)), '\n'.join(lines) + '\n')
+
+        for m in range(self.pymods):
+            _write(os.path.join(pkgdir, "src", "mod%d.py" % m), "def f():\n    return %d\n" % m)
+
+        if self.pyext:
+            lines = ['#include <Python.h>', '#include "%s/hdr0.h"' % pkg,
+                     'static PyMethodDef methods[] = { {NULL, NULL, 0, NULL} };',
+                     'static struct PyModuleDef module = { PyModuleDef_HEAD_INIT, "%s", NULL, -1, methods };' % pkg,
+                     'PyMODINIT_FUNC PyInit_%s(void) { return PyModule_Create(&module); }' % pkg]
+            _write(os.path.join(pkgdir, "pyext", "ext.cpp"), '\n'.join(lines) + '\n')
+
+
+class Builder(object):
+    """Runs scons in a release and collects measurements"""
+
+    def __init__(self, scons="scons", jobs=None, sitArch=None, condaPrefix=None, extraArgs=(), hashSeed=0):
+        self.scons = scons
+        self.jobs = jobs
+        self.hashSeed = hashSeed
+        self.sitArch = sitArch or os.environ.get('SIT_ARCH', 'x86_64-rhel7-gcc48-opt')
+        self.condaPrefix = condaPrefix or os.environ.get('CONDA_PREFIX', sys.prefix)
+        self.extraArgs = list(extraArgs)
+
+    def environ(self, reldir, repos=()):
+        """Environment for building in the release"""
+        env = dict(os.environ)
+        for var in ['PREFIX', 'CONDA_ENV_PATH']: env.pop(var, None)
+        env['SIT_ARCH'] = self.sitArch
+        env['SIT_RELEASE'] = open(os.path.join(reldir, ".sit_release")).read().strip()
+        env['SIT_USE_CONDA'] = '1'
+        env['CONDA_PREFIX'] = self.condaPrefix
+        env['SIT_REPOS'] = ':'.join(repos)
+        env['PYTHONPATH'] = ':'.join(os.path.join(r, "arch", self.sitArch, "python") for r in [reldir] + list(repos))
+        env['PYTHONHASHSEED'] = str(self.hashSeed)
+        return env
+
+    def clean(self, reldir):
+        for d in ["build", "arch", "include", "data", "web", ".pkg_tree.pkl"]:
+            p = os.path.join(reldir, d)
+            if os.path.isdir(p) and not os.path.islink(p):
+                shutil.rmtree(p)
+            elif os.path.lexists(p):
+                os.remove(p)
+
+    def run(self, reldir, repos=(), args=(), check=True):
+        """
+        Run scons with profiling, returns dictionary with wall time measured
+        outside of scons, exit code and the profile.
+        """
+        cmd = [self.scons, '-Q', 'PROFILE=1'] + self.extraArgs + list(args)
+        if self.jobs: cmd.append('-j%d' % self.jobs)
+        profile = os.path.join(reldir, "build", self.sitArch, "profile.json")
+        scanStats = os.path.join(reldir, "build", self.sitArch, "scan_stats.json")
+        for f in [profile, scanStats]:
+            if os.path.exists(f): os.remove(f)
+
+        t0 = time.time()
+        out = open(os.path.join(reldir, "benchmark.log"), 'a')
+        out.write("\n$ %s\n" % ' '.join(cmd))
+        out.flush()
+        rc = subprocess.call(cmd, cwd=reldir, env=self.environ(reldir, repos), stdout=out, stderr=subprocess.STDOUT)
+        out.close()
+        wall = time.time() - t0
+        if rc != 0 and check:
+            raise RuntimeError("scons failed in %s with code %d, see %s" % (reldir, rc, os.path.join(reldir, "benchmark.log")))
+
+        res = dict(wall=wall, rc=rc)
+        if os.path.exists(profile):
+            res['profile'] = json.load(open(profile))
+        if os.path.exists(scanStats):
+            res['scan_stats'] = json.load(open(scanStats))
+        return res
+
+    def commands(self, reldir, repos=()):
+        """Run scons in dry-run mode, returns sorted list of commands it would execute"""
+        cmd = [self.scons, '-Q', '-n'] + self.extraArgs
+        proc = subprocess.Popen(cmd, cwd=reldir, env=self.environ(reldir, repos),
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        out = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise RuntimeError("scons -n failed in %s with code %d:\n%s" % (reldir, proc.returncode, out))
+        lines = [l for l in out.splitlines() if not l.startswith('Mkdir') and not l.endswith("' is up to date.")]
+        return sorted(lines)
+
+
+def phaseTimes(result):
+    """Extract times of the top-level phases from the run result"""
+    phases = dict(total=result['wall'])
+    prof = result.get('profile')
+    if not prof: return phases
+    for p in prof['phases']:
+        if p['depth'] == 0 and p['cat'] == 'phase':
+            phases[p['name']] = p['wall']
+            if p['name'] == 'DAG walk' and 'nodes' in p: phases['nodes'] = p['nodes']
+    phases['startup'] = sum(phases.get(n, 0.) for n in ['bootstrap', 'buildEnv', 'makePackageLinks', 'loadPkgDeps'])
+    phases['maxrss_kb'] = prof['maxrss_kb']
+    if 'scan_stats' in result: phases['scans'] = result['scan_stats']['files']
+    return phases
+
+
+def _makeReleases(args, workdir, npkgs, builder):
+    """Generate base (optional) and main release, returns (reldir, repos)"""
+    repos = []
+    base = None
+    if args.base:
+        base = ReleaseGenerator(args.base, args.depth, args.fanout, args.headers, args.srcs, args.apps,
+                                args.tests, args.python, args.pyext, prefix="Base", seed=args.seed + 1)
+        basedir = os.path.join(workdir, "base%d" % args.base)
+        if not os.path.isdir(basedir):
+            base.generate(basedir, "base%d" % args.base, builder.condaPrefix, builder.sitArch)
+            builder.run(basedir)
+        repos.append(basedir)
+
+    gen = ReleaseGenerator(npkgs, args.depth, args.fanout, args.headers, args.srcs, args.apps,
+                           args.tests, args.python, args.pyext, seed=args.seed)
+    reldir = os.path.join(workdir, "rel%d" % npkgs)
+    if os.path.isdir(reldir): shutil.rmtree(reldir)
+    gen.generate(reldir, "rel%d" % npkgs, builder.condaPrefix, builder.sitArch, base)
+    return reldir, repos
+
+
+def _addGeneratorOptions(parser):
+    parser.add_argument('--depth', type=int, default=5, help="number of levels in the package graph, def: %(default)s")
+    parser.add_argument('--fanout', type=int, default=3, help="number of packages included by each package, def: %(default)s")
+    parser.add_argument('--headers', type=int, default=3, help="headers per package, def: %(default)s")
+    parser.add_argument('--srcs', type=int, default=2, help="library sources per package, def: %(default)s")
+    parser.add_argument('--apps', type=int, default=1, help="applications per package, def: %(default)s")
+    parser.add_argument('--tests', type=int, default=0, help="tests per package, def: %(default)s")
+    parser.add_argument('--python', type=int, default=0, help="python modules per package, def: %(default)s")
+    parser.add_argument('--pyext', type=int, default=0, help="set to 1 to add python extension module to each package")
+    parser.add_argument('--base', type=int, default=0, help="number of packages in base release, 0 for no base release")
+    parser.add_argument('--seed', type=int, default=12345, help="random seed, def: %(default)s")
+
+
+def _addBuildOptions(parser):
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="number of parallel jobs for scons")
+    parser.add_argument('--scons', default="scons", help="scons command, def: %(default)s")
+    parser.add_argument('--sit-arch', default=None, help="SIT_ARCH value, def: $SIT_ARCH")
+    parser.add_argument('--conda-prefix', default=None, help="conda environment, def: $CONDA_PREFIX")
+
+
+def _generate(args):
+    gen = ReleaseGenerator(args.packages, args.depth, args.fanout, args.headers, args.srcs, args.apps,
+                           args.tests, args.python, args.pyext, seed=args.seed)
+    builder = Builder(sitArch=args.sit_arch, condaPrefix=args.conda_prefix)
+    gen.generate(args.reldir, os.path.basename(os.path.abspath(args.reldir)), builder.condaPrefix, builder.sitArch)
+    print("Generated release with %d packages in %s" % (args.packages, args.reldir))
+
+
+def _scale(args):
+
+    builder = Builder(args.scons, args.jobs, args.sit_arch, args.conda_prefix)
+    workdir = os.path.abspath(args.workdir)
+    sizes = [int(n) for n in args.packages.split(',')]
+
+    cols = ['startup', 'SConscript', 'adjustPkgDeps', 'DAG walk', 'total']
+    print("%8s %6s  " % ("packages", "build") + ' '.join("%13s" % c for c in cols))
+    results = []
+    for npkgs in sizes:
+        reldir, repos = _makeReleases(args, workdir, npkgs, builder)
+        res = dict(packages=npkgs)
+        for name in ['full', 'noop']:
+            res[name] = phaseTimes(builder.run(reldir, repos))
+            print("%8d %6s  " % (npkgs, name) + ' '.join("%13.2f" % res[name].get(c, 0.) for c in cols))
+        results.append(res)
+
+    if args.output:
+        opts = dict((k, v) for k, v in vars(args).items() if k != 'func')
+        json.dump(dict(options=opts, results=results), open(args.output, 'w'), indent=1, sort_keys=True)
+        print("Results written to %s" % args.output)
+
+
+# parameters of the fixed sample release for regression checks
+_regressRelease = dict(packages=100, depth=5, fanout=3, headers=3, srcs=2, apps=1, tests=0, python=0, pyext=0, base=20, seed=12345)
+
+# metrics compared with the baseline, for times the difference also has to be
+# larger than absolute tolerance to count as regression
+_regressMetrics = ['total', 'startup', 'SConscript', 'adjustPkgDeps', 'DAG walk', 'nodes', 'scans', 'maxrss_kb']
+_timeMetrics = ['total', 'startup', 'SConscript', 'adjustPkgDeps', 'DAG walk']
+
+
+def _regress(args):
+
+    if not args.save_baseline and not os.path.exists(args.baseline):
+        print("Baseline %s does not exist, create it with --save-baseline" % args.baseline)
+        return 2
+
+    builder = Builder(args.scons, args.jobs, args.sit_arch, args.conda_prefix, extraArgs=['SCAN_STATS=1'])
+    workdir = os.path.abspath(args.workdir)
+
+    relargs = argparse.Namespace(**_regressRelease)
+    reldir, repos = _makeReleases(relargs, workdir, relargs.packages, builder)
+
+    # header of a package in the first level, touching it rebuilds a large part of the release
+    header = os.path.join(reldir, "%s%04d" % ("Pkg", 0), "include", "hdr0.h")
+
+    def touchHeader():
+        # change the content, not only time, so that any decider sees the change
+        f = open(header, 'a')
+        f.write("// touched %f\n" % time.time())
+        f.close()
+
+    # each repetition of cold build starts from scratch, no-op builds follow
+    # a complete build, every touched-header build changes the header again
+    runs = [('cold', lambda: builder.clean(reldir)), ('noop', None), ('touch', touchHeader)]
+    results = {}
+    for name, prepare in runs:
+        best = None
+        for i in range(args.repeat):
+            if prepare is not None: prepare()
+            res = phaseTimes(builder.run(reldir, repos))
+            if best is None:
+                best = res
+            else:
+                for k, v in res.items(): best[k] = min(best.get(k, v), v)
+        results[name] = best
+        print("%-6s " % name + ' '.join("%s=%s" % (m, _fmt(best.get(m))) for m in _regressMetrics))
+
+    if args.save_baseline:
+        data = dict(release=_regressRelease, results=results)
+        json.dump(data, open(args.baseline, 'w'), indent=1, sort_keys=True)
+        print("Baseline written to %s" % args.baseline)
+        return 0
+
+    baseline = json.load(open(args.baseline))
+    if baseline.get('release') != _regressRelease:
+        print("Baseline %s was made for a different sample release, re-create it with --save-baseline" % args.baseline)
+        return 2
+
+    regressions = []
+    for name, res in sorted(results.items()):
+        base = baseline['results'].get(name, {})
+        for m in _regressMetrics:
+            old, new = base.get(m), res.get(m)
+            if old is None or new is None: continue
+            limit = old * (1. + args.threshold)
+            if m in _timeMetrics: limit = max(limit, old + args.min_time)
+            if new > limit:
+                regressions.append("%s %s: %s -> %s (%+.1f%%)" % (name, m, _fmt(old), _fmt(new), 100.*(new-old)/old if old else 0.))
+
+    if regressions:
+        print("Regressions above %.0f%% compared to %s:" % (args.threshold*100, args.baseline))
+        for r in regressions: print("  " + r)
+        return 1
+    print("No regressions compared to %s" % args.baseline)
+    return 0
+
+
+def _determinism(args):
+
+    seeds = args.hash_seeds
+    builders = [Builder(args.scons, args.jobs, args.sit_arch, args.conda_prefix, hashSeed=seed) for seed in seeds]
+    workdir = os.path.abspath(args.workdir)
+    reldir, repos = _makeReleases(args, workdir, args.packages, builders[0])
+
+    # command lines of a clean build must not depend on hash seed
+    failed = False
+    commands = []
+    for builder in builders:
+        builder.clean(reldir)
+        commands.append(builder.commands(reldir, repos))
+    for seed, cmds in zip(seeds[1:], commands[1:]):
+        if cmds != commands[0]:
+            failed = True
+            diff = difflib.unified_diff(commands[0], cmds, "PYTHONHASHSEED=%d" % seeds[0], "PYTHONHASHSEED=%d" % seed, lineterm='')
+            print("Build commands differ between PYTHONHASHSEED=%d and %d:" % (seeds[0], seed))
+            for line in list(diff)[:args.max_diff]: print("  " + line)
+
+    # after complete build with one seed nothing is rebuilt with the others
+    builders[0].clean(reldir)
+    builders[0].run(reldir, repos)
+    for seed, builder in zip(seeds[1:], builders[1:]):
+        cmds = builder.commands(reldir, repos)
+        if cmds:
+            failed = True
+            print("No-op build with PYTHONHASHSEED=%d after build with PYTHONHASHSEED=%d rebuilds %d targets:" %
+                  (seed, seeds[0], len(cmds)))
+            for line in cmds[:args.max_diff]: print("  " + line)
+
+    if failed: return 1
+    print("Builds of %d packages are identical for PYTHONHASHSEED=%s" % (args.packages, ','.join(map(str, seeds))))
+    return 0
+
+
+def _fmt(v):
+    if isinstance(v, float): return "%.3f" % v
+    return str(v)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Synthetic releases and benchmarks for SConsTools")
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('generate', help="generate synthetic release")
+    p.add_argument('-n', '--packages', type=int, default=50, help="number of packages, def: %(default)s")
+    _addGeneratorOptions(p)
+    p.add_argument('--sit-arch', default=None, help="SIT_ARCH value, def: $SIT_ARCH")
+    p.add_argument('--conda-prefix', default=None, help="conda environment, def: $CONDA_PREFIX")
+    p.add_argument('reldir', help="release directory")
+    p.set_defaults(func=_generate)
+
+    p = sub.add_parser('scale', help="measure full and no-op build times for a range of release sizes")
+    p.add_argument('-n', '--packages', default="50,200,1000,2000", help="comma-separated release sizes, def: %(default)s")
+    p.add_argument('-o', '--output', default=None, help="file name for JSON results")
+    _addGeneratorOptions(p)
+    _addBuildOptions(p)
+    p.add_argument('workdir', help="directory for generated releases")
+    p.set_defaults(func=_scale)
+
+    p = sub.add_parser('regress', help="cold, no-op and touched-header builds of a fixed release compared with a baseline")
+    p.add_argument('-b', '--baseline', required=True, help="baseline file (JSON), compared with or written with --save-baseline")
+    p.add_argument('--save-baseline', action='store_true', default=False, help="store results as a new baseline instead of comparing")
+    p.add_argument('-t', '--threshold', type=float, default=0.2, help="allowed relative increase of a metric, def: %(default)s")
+    p.add_argument('--min-time', type=float, default=0.5, help="time differences below this (seconds) are ignored, def: %(default)s")
+    p.add_argument('-r', '--repeat', type=int, default=1, help="repeat each build and take the best values, def: %(default)s")
+    _addBuildOptions(p)
+    p.add_argument('workdir', help="directory for generated releases")
+    p.set_defaults(func=_regress)
+
+    p = sub.add_parser('determinism', help="check that build does not depend on python hash seed")
+    p.add_argument('-n', '--packages', type=int, default=50, help="number of packages, def: %(default)s")
+    p.add_argument('--hash-seeds', type=lambda s: [int(x) for x in s.split(',')], default=[1, 2],
+                   help="comma-separated PYTHONHASHSEED values, def: 1,2")
+    p.add_argument('--max-diff', type=int, default=40, help="maximum number of differences to print, def: %(default)s")
+    _addGeneratorOptions(p)
+    _addBuildOptions(p)
+    p.add_argument('workdir', help="directory for generated releases")
+    p.set_defaults(func=_determinism)
+
+    args = parser.parse_args(argv)
+    if not getattr(args, 'func', None):
+        parser.print_help()
+        return 2
+    return args.func(args) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
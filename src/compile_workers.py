@@ -0,0 +1,547 @@
+#===============================================================================
+#
+# Distributed compilation on a pool of worker processes
+#
+# $Id$
+#
+#===============================================================================
+
+"""
+Sends C/C++ compilations to compile workers over TCP. The source is
+preprocessed locally, so the worker only needs the same compiler and does
+not need access to the release or its include files; the worker compiles
+the preprocessed source and sends back the object file.
+
+Worker is started with this script, on the build host itself or on other
+hosts which have the same compiler installed:
+
+    compile_workers.py [-H 0.0.0.0] [-p 3633] [-j 8] [-c g++ ...]
+
+and the build is pointed to the workers with COMPILE_WORKERS option:
+
+    scons COMPILE_WORKERS=localhost:3633,node2:3633
+
+Worker listens on 127.0.0.1 unless other address is given with -H. Worker
+and builds share a secret, a file which is only readable by its owner
+(~/.compile_worker_secret by default, --secret-file option of the worker
+and COMPILE_WORKERS_SECRET option of the build), e.g.:
+
+    head -c 32 /dev/urandom | base64 > ~/.compile_worker_secret
+    chmod 600 ~/.compile_worker_secret
+
+Worker only runs compilers given with -c options (gcc, g++, cc and c++ by
+default) found in its PATH, the client only sends the name of the
+compiler, and it refuses options which make the compiler run other
+programs or read and write files outside of its temporary directory
+(-wrapper, -B, -fplugin, -specs, @file, -Wa, -fdump, -fprofile, etc.).
+
+The build then runs as many jobs in parallel as local CPUs plus the
+worker slots. Commands which are not plain compilations (linking, ccache,
+split DWARF, etc.) and compilations for which no worker slot is free or
+the worker cannot be reached are run locally.
+
+Protocol: every message is a 4-byte big-endian length, 32-byte HMAC-SHA256
+of the header made with the shared secret, JSON header of that length and
+then header['size'] bytes of data whose SHA256 is in header['digest'].
+Messages with wrong HMAC or digest are dropped. Requests are {"op": "ping"}
+and {"op": "compile", "compiler": ..., "version": ..., "args": [...],
+"lang": ..., "size": ...} followed by the preprocessed source; replies have
+"status" and "stderr", compile reply is followed by the object file.
+
+This script does not need SCons.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import hmac
+import json
+import shlex
+import shutil
+import socket
+import struct
+import hashlib
+import tempfile
+import argparse
+import threading
+import subprocess
+
+if sys.version_info[0] < 3:
+    import SocketServer as socketserver
+else:
+    import socketserver
+
+DEFAULT_PORT = 3633
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_SECRET_FILE = '~/.compile_worker_secret'
+
+# compilers which worker runs if none are given
+_defaultCompilers = ['gcc', 'g++', 'cc', 'c++']
+
+# limit for JSON header size, data size is only trusted after HMAC check
+_maxHeader = 1 << 20
+
+# timeout for connecting to worker and for the whole compilation
+_connectTimeout = 2.
+_compileTimeout = 600.
+
+# options which only matter to preprocessor, second element is True for
+# options which take the next argument
+_cppOptions = [('-I', False), ('-D', False), ('-U', False), ('-include', True),
+               ('-isystem', True), ('-iquote', True), ('-imacros', True),
+               ('-MD', False), ('-MMD', False), ('-MF', True), ('-MT', True), ('-MQ', True),
+               ('-Winvalid-pch', False), ('-fpch-preprocess', False)]
+
+# languages of preprocessed sources
+_langs = { '.c' : 'cpp-output',
+           '.cc' : 'c++-cpp-output',
+           '.cpp' : 'c++-cpp-output',
+           '.cxx' : 'c++-cpp-output',
+           '.C' : 'c++-cpp-output' }
+
+# shell characters which we do not want to handle outside of shell, quotes
+# are fine, SCons puts file names in quotes
+_shellChars = set('`$\\|&;<>()*?[]{}~!#')
+
+# prefixes of options which run other programs, load code into compiler or
+# read/write files by name; compilations with them are done locally
+_unsafeOptions = ('-wrapper', '-B', '-fplugin', '-iplugindir', '-specs', '--specs', '@',
+                  '-o', '--output', '-x', '-Wa,', '-Xassembler', '-Wp,', '-Xpreprocessor',
+                  '-Wl,', '-Xlinker', '-M', '-fdump', '-fprofile', '-fauto-profile',
+                  '-fcreate-profile', '-fopt-info', '-fcallgraph-info', '-fcompare-debug',
+                  '-fmodule-mapper', '-save-temps', '-aux-info', '-dumpdir', '-dumpbase')
+
+
+def _unsafeOption(arg):
+    """True for arguments which are not allowed on compile worker"""
+    return not arg.startswith('-') or arg.startswith(_unsafeOptions)
+
+
+class AuthError(ValueError):
+    """Message does not have correct HMAC or data digest"""
+    pass
+
+
+def readSecret(fileName=None):
+    """Returns the shared secret (bytes) from the file, or None if file is missing or empty"""
+    fileName = os.path.expanduser(fileName or DEFAULT_SECRET_FILE)
+    try:
+        f = open(fileName, 'rb')
+        try:
+            secret = f.read().strip()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+    if os.stat(fileName).st_mode & 0o077:
+        print("WARNING: secret file %s is readable by other users" % fileName, file=sys.stderr)
+    return secret or None
+
+
+def _mac(secret, hdr):
+    return hmac.new(secret, hdr, hashlib.sha256).digest()
+
+
+def _sendMsg(sock, secret, header, data=b''):
+    header = dict(header, size=len(data), digest=hashlib.sha256(data).hexdigest())
+    hdr = json.dumps(header).encode('utf-8')
+    sock.sendall(struct.pack('>I', len(hdr)) + _mac(secret, hdr) + hdr + data)
+
+
+def _recvAll(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk: raise EOFError("connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _recvMsg(sock, secret):
+    size = struct.unpack('>I', _recvAll(sock, 4))[0]
+    if size > _maxHeader: raise AuthError("header too large")
+    mac = _recvAll(sock, hashlib.sha256().digest_size)
+    hdr = _recvAll(sock, size)
+    if not hmac.compare_digest(mac, _mac(secret, hdr)): raise AuthError("wrong HMAC")
+    header = json.loads(hdr.decode('utf-8'))
+    data = _recvAll(sock, header.get('size', 0))
+    if hashlib.sha256(data).hexdigest() != header.get('digest'): raise AuthError("wrong data digest")
+    return header, data
+
+
+_versions = {}
+_versionsLock = threading.Lock()
+
+def compilerVersion(compiler, environ=None):
+    """First line of `compiler --version`, or None if compiler does not run"""
+    with _versionsLock:
+        if compiler not in _versions:
+            try:
+                p = subprocess.Popen([compiler, '--version'], env=environ, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                out = p.communicate()[0].decode('utf-8', 'replace')
+                _versions[compiler] = out.splitlines()[0].strip() if p.returncode == 0 and out else None
+            except OSError:
+                _versions[compiler] = None
+        return _versions[compiler]
+
+
+# ===================================
+#   Worker
+# ===================================
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        secret = self.server.secret
+        try:
+            header, data = _recvMsg(self.request, secret)
+        except AuthError as e:
+            # no reply, peer does not know the secret
+            print("Compile worker: rejected request from %s: %s" % (self.client_address[0], e), file=sys.stderr)
+            return
+        except (EOFError, ValueError, socket.error):
+            return
+        if header.get('op') == 'ping':
+            _sendMsg(self.request, secret, dict(status=0, jobs=self.server.jobs))
+        elif header.get('op') == 'compile':
+            with self.server.slots:
+                reply, obj = self._compile(header, data)
+            _sendMsg(self.request, secret, reply, obj)
+        else:
+            _sendMsg(self.request, secret, dict(status=-1, stderr="unknown request"))
+
+    def _compile(self, header, data):
+
+        # errors here are not errors of the compiled code, client will compile locally
+        name = header.get('compiler')
+        compiler = self.server.compilers.get(name)
+        version = compilerVersion(compiler) if compiler else None
+        if version is None or version != header.get('version'):
+            return dict(status=-1, stderr="compiler %s (%s) not available" % (name, header.get('version'))), b''
+        args = header.get('args')
+        if not isinstance(args, list) or [a for a in args if not isinstance(a, type(u'')) or _unsafeOption(a)]:
+            return dict(status=-1, stderr="compiler options are not allowed: %s" % (args,)), b''
+        if header.get('lang') not in _langs.values():
+            return dict(status=-1, stderr="unknown language: %s" % header.get('lang')), b''
+
+        tmpdir = tempfile.mkdtemp(prefix='compile-worker-')
+        try:
+            src = os.path.join(tmpdir, 'input.i')
+            obj = os.path.join(tmpdir, 'output.o')
+            f = open(src, 'wb')
+            f.write(data)
+            f.close()
+            cmd = [compiler] + args + ['-x', header['lang'], '-c', src, '-o', obj]
+            if header.get('cwd'):
+                # debug info should have directory of the client
+                cmd.insert(1, '-fdebug-prefix-map=%s=%s' % (tmpdir, header['cwd']))
+            p = subprocess.Popen(cmd, cwd=tmpdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            out = p.communicate()[0].decode('utf-8', 'replace')
+            res = b''
+            if p.returncode == 0:
+                f = open(obj, 'rb')
+                res = f.read()
+                f.close()
+            # do not show temporary file names to the user
+            out = out.replace(src, header.get('source', src))
+            return dict(status=p.returncode, stderr=out), res
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, jobs, compilers, secret):
+        socketserver.TCPServer.__init__(self, address, _Handler)
+        self.jobs = jobs
+        self.compilers = compilers
+        self.secret = secret
+        self.slots = threading.BoundedSemaphore(jobs)
+
+
+def _which(name):
+    """Absolute path of executable found in PATH, or None"""
+    if os.path.dirname(name):
+        return os.path.abspath(name) if os.access(name, os.X_OK) else None
+    for d in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(d, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return os.path.abspath(path)
+    return None
+
+
+def serve(host, port, jobs, compilers, secret):
+    """
+    Run compile worker until interrupted, compilers is a dictionary which
+    maps compiler names which clients send to absolute paths
+    """
+    server = _Server((host, port), jobs, compilers, secret)
+    print("Compile worker listening on %s:%d with %d jobs, compilers: %s" %
+          (host or '*', port, jobs, ' '.join(sorted(compilers.values()))))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+# ===================================
+#   Client
+# ===================================
+
+class _Worker(object):
+
+    def __init__(self, host, port, jobs, secret):
+        self.host = host
+        self.port = port
+        self.slots = threading.BoundedSemaphore(jobs)
+        self.jobs = jobs
+        self.secret = secret
+        self.alive = True
+
+    def __str__(self):
+        return "%s:%d" % (self.host, self.port)
+
+    def request(self, header, data=b'', timeout=_compileTimeout):
+        sock = socket.create_connection((self.host, self.port), _connectTimeout)
+        try:
+            sock.settimeout(timeout)
+            _sendMsg(sock, self.secret, header, data)
+            return _recvMsg(sock, self.secret)
+        finally:
+            sock.close()
+
+
+def _parseWorkers(spec):
+    for item in spec.replace(',', ' ').split():
+        host, _, port = item.partition(':')
+        yield host or 'localhost', int(port or DEFAULT_PORT)
+
+
+class WorkerPool(object):
+    """Compile workers which answered ping, and counters of remote and local compilations"""
+
+    def __init__(self, spec, secret):
+        self.workers = []
+        for host, port in _parseWorkers(spec):
+            w = _Worker(host, port, 1, secret)
+            try:
+                header, _ = w.request(dict(op='ping'), timeout=_connectTimeout)
+            except (socket.error, EOFError, ValueError) as e:
+                print("WARNING: compile worker %s is not reachable: %s" % (w, e), file=sys.stderr)
+                continue
+            self.workers.append(_Worker(host, port, int(header.get('jobs', 1)), secret))
+        self.remote = 0
+        self.local = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def jobs(self):
+        return sum(w.jobs for w in self.workers if w.alive)
+
+    def _acquire(self):
+        for w in self.workers:
+            if w.alive and w.slots.acquire(False):
+                return w
+        return None
+
+    def _count(self, what):
+        with self._lock:
+            setattr(self, what, getattr(self, what) + 1)
+
+    def compile(self, args, environ):
+        """
+        Try to compile remotely, returns exit code or None if command has to
+        be executed locally
+        """
+        job = _splitCompile(args)
+        if job is None: return None
+        worker = self._acquire()
+        if worker is None:
+            self._count('local')
+            return None
+        try:
+            compiler, cppargs, ccargs, source, target, lang = job
+            version = compilerVersion(compiler, environ)
+            if version is None: return None
+
+            # preprocess locally
+            p = subprocess.Popen([compiler, '-E'] + cppargs + [source], env=environ,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            data, err = p.communicate()
+            if p.returncode != 0:
+                # let the local compiler report the error
+                self._count('local')
+                return None
+
+            # worker runs its own compiler with the same name and version
+            header = dict(op='compile', compiler=os.path.basename(compiler), version=version, args=ccargs, lang=lang,
+                          source=source, cwd=os.getcwd())
+            try:
+                reply, obj = worker.request(header, data)
+            except (socket.error, EOFError, ValueError) as e:
+                print("WARNING: compile worker %s failed, disabling it: %s" % (worker, e), file=sys.stderr)
+                worker.alive = False
+                self._count('failed')
+                return None
+            if reply['status'] < 0:
+                self._count('failed')
+                return None
+
+            if reply.get('stderr'): sys.stderr.write(reply['stderr'])
+            if reply['status'] == 0:
+                d = os.path.dirname(target)
+                if d and not os.path.isdir(d): os.makedirs(d)
+                f = open(target, 'wb')
+                f.write(obj)
+                f.close()
+            self._count('remote')
+            return reply['status']
+        finally:
+            worker.slots.release()
+
+    def report(self):
+        print("Compile workers: %d compilations remote, %d local, %d failed remote" %
+              (self.remote, self.local, self.failed))
+
+
+def _splitCompile(args):
+    """
+    For a plain compiler command line returns (compiler, preprocessor
+    arguments, compiler arguments, source, target, language), or None
+    """
+    line = ' '.join(args)
+    if _shellChars.intersection(line): return None
+    try:
+        args = shlex.split(line)
+    except ValueError:
+        return None
+    if '-c' not in args or '-o' not in args: return None
+    if os.path.basename(args[0]).startswith('ccache'): return None
+    for a in args:
+        if a in ('-E', '-S', '-M', '-MM', '-gsplit-dwarf') or a.startswith('-x'): return None
+
+    compiler = args[0]
+    cppargs = []
+    ccargs = []
+    sources = []
+    target = None
+    i = 1
+    while i < len(args):
+        a = args[i]
+        if a == '-o':
+            if i + 1 >= len(args): return None
+            target = args[i+1]
+            i += 2
+            continue
+        if a == '-c':
+            i += 1
+            continue
+        cpp = [opt for opt in _cppOptions if a == opt[0] or (not opt[1] and len(opt[0]) == 2 and a.startswith(opt[0]))]
+        if cpp:
+            if cpp[0][1]:
+                if i + 1 >= len(args): return None
+                cppargs += args[i:i+2]
+                i += 2
+            else:
+                cppargs.append(a)
+                i += 1
+            continue
+        if a.startswith('-'):
+            # code generation options may change predefined macros, pass them to both
+            cppargs.append(a)
+            ccargs.append(a)
+        else:
+            sources.append(a)
+        i += 1
+
+    if len(sources) != 1 or target is None: return None
+    if [a for a in ccargs if _unsafeOption(a)]: return None
+    lang = _langs.get(os.path.splitext(sources[0])[1])
+    if lang is None: return None
+    return compiler, cppargs, ccargs, sources[0], target, lang
+
+
+def _makeSpawn(spawn, pool):
+    """Returns SPAWN function which runs compilations on workers"""
+
+    def _spawn(sh, escape, cmd, args, env):
+        rc = pool.compile(args, env)
+        if rc is None:
+            rc = spawn(sh, escape, cmd, args, env)
+        return rc
+
+    # tells action stats to call this function instead of running commands itself
+    _spawn.delegate = True
+    return _spawn
+
+
+def enableCompileWorkers(env, spec, ncpu, secretFile=None):
+    """
+    Connect to compile workers given as comma-separated host:port list,
+    install SPAWN which uses them and increase number of jobs. Returns the
+    pool or None if no worker is reachable.
+    """
+    import atexit
+    from SCons.Script import SetOption, GetOption
+
+    secret = readSecret(secretFile)
+    if secret is None:
+        print("WARNING: secret file %s for compile workers is missing, compiling locally" %
+              (secretFile or DEFAULT_SECRET_FILE), file=sys.stderr)
+        return None
+
+    pool = WorkerPool(spec, secret)
+    if not pool.workers:
+        print("WARNING: no compile workers are reachable, compiling locally", file=sys.stderr)
+        return None
+
+    env['SPAWN'] = _makeSpawn(env['SPAWN'], pool)
+    SetOption('num_jobs', max(GetOption('num_jobs'), ncpu + pool.jobs()))
+    atexit.register(pool.report)
+    return pool
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Compile worker for distributed SConsTools builds")
+    parser.add_argument('-H', '--host', default=DEFAULT_HOST, help="address to listen on, 0.0.0.0 for all, def: %(default)s")
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT, help="port number, def: %(default)s")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="number of parallel compilations, def: number of CPUs")
+    parser.add_argument('-c', '--compiler', action='append', default=None,
+                        help="compiler which clients may use, name or path, can be repeated, def: %s" % ' '.join(_defaultCompilers))
+    parser.add_argument('-s', '--secret-file', default=DEFAULT_SECRET_FILE, help="file with secret shared with clients, def: %(default)s")
+    args = parser.parse_args(argv)
+
+    secret = readSecret(args.secret_file)
+    if secret is None:
+        print("Secret file %s is missing or empty" % args.secret_file, file=sys.stderr)
+        return 2
+
+    compilers = {}
+    for name in args.compiler or _defaultCompilers:
+        path = _which(name)
+        if path is None:
+            if args.compiler: print("WARNING: compiler %s is not found" % name, file=sys.stderr)
+            continue
+        compilers[os.path.basename(name)] = path
+    if not compilers:
+        print("No compilers found", file=sys.stderr)
+        return 2
+
+    jobs = args.jobs
+    if jobs is None:
+        try:
+            jobs = os.sysconf('SC_NPROCESSORS_ONLN')
+        except (ValueError, OSError, AttributeError):
+            jobs = 2
+    serve(args.host, args.port, jobs, compilers, secret)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -42,17 +42,24 @@ import sys
 import re
 import six
 import glob
+import json
+import time
+import struct
+import threading
+from six.moves import queue
 try:
   import cPickle as pickle
 except ImportError:
   import pickle
 from pprint import *
 
+import SCons.Node.FS
+import SCons.Scanner
 from SCons.Script import *
 
 from SConsTools.trace import *
 from SConsTools.scons_functions import *
-from SConsTools.scons_env import get_conda_env_path
+from SConsTools.pkg_tree_file import PkgTreeFile, readPkgTree, writePkgTree
 
 def which_pdsdata_pkg_for_file_in_pdsdata(f):
     # .../arch/$SIT_ARCH/geninc/pdsdata/package/File
@@ -83,57 +90,12 @@ _boostPackages = {
 def _guessBoostPackage ( p ) :
     return _boostPackages.get ( p, 'boost' )
 
-def _guessPackageFromFileInCondaEnv( path ):
-    trace ( "checking dependencies for %s"%path, "condaPkgDeps", 4 )
-    conda_prefix = get_conda_env_path(fail_if_not_conda=True)
-    conda_include = os.path.join(conda_prefix, 'include')
-    if not path.startswith(conda_include):
-        trace ( "doesn't start with conda_include: %s" % path, "condaPkgDeps", 4 )
-        return None
-    after = path.split(conda_include)[1]
-    after = after.split(os.sep)
-    if len(after)>0 and after[0]=='':
-        after.pop(0)
-    if len(after)==0:
-        trace ( "nothing after: %s" % path, "condaPkgDeps", 4 )
-        return None
-    if len(after)==1:
-        if after[0] in ['hdf5.h', 'hdf5_hl.h']:
-            trace ( "identified hdf5 in conda: %s" % path, "condaPkgDeps", 4 )
-            return 'hdf5'
-        if after[0]=='mpi.h':
-            # we assume openmpi provides the mpi implementation in the conda environments
-            trace ( "identified openmpi in conda: %s" % path, "condaPkgDeps", 4 )
-            return 'openmpi'
-        return None
-    if after[0]=='pdsdata':
-        trace ( "identified pdsdata in conda: %s" % path, "condaPkgDeps", 4 )
-        if after[1]=='xtc':
-            trace ( "xtc pdsdata, returning pdsdata: %s" % path, "condaPkgDeps", 4 )
-            return 'pdsdata'
-        pkg = 'pdsdata_%s' % after[1]
-        trace ( "%s pdsdata pkg for path=%s" % (pkg, path), "condaPkgDeps", 4 )
-        return pkg
-
-    if after[0]=='boost':
-        pkg =  _guessBoostPackage(after[1])
-        trace ( "boost pkg=%s for path=%s" % (pkg, path), "condaPkgDeps", 4 )
-        return pkg
-    trace ( "no package identified for after conda_include=%s" % (after,), "condaPkgDeps", 4 )
-    return None
-
 def _guessPackage ( path ):
-    env = DefaultEnvironment()
-    if env['CONDA']:
-        pkg = _guessPackageFromFileInCondaEnv(path)
-        if pkg:
-            return pkg
-
 
     f = path.split(os.sep)
     f.reverse() # for easier counting and reverse searching
 
-    trace ( 'path: %s' % f, '_guessPackage', 9 )
+    trace ( 'path: %s', '_guessPackage', 9, f )
 
     #
     # First try to see if it comes from boost, in which case it
@@ -145,7 +107,7 @@ def _guessPackage ( path ):
             if i > 1 and i+2 < len(f) and f[i-1] == 'boost' and f[i+2] == 'arch' :
                 p = _guessBoostPackage ( f[i-2] )
                 if p :
-                    trace ( 'Child comes from boost/%s' % p, '_guessPackage', 8 )
+                    trace ( 'Child comes from boost/%s', '_guessPackage', 8, p )
                     return p
         except :
             # probably not boost, do other tests
@@ -159,11 +121,11 @@ def _guessPackage ( path ):
                 pkg = 'pdsdata'
             else:
                 pkg = 'pdsdata_' + f[x-2]
-            trace ( 'Child comes from %s' % pkg, '_guessPackage', 8 )
+            trace ( 'Child comes from %s', '_guessPackage', 8, pkg )
             return pkg
         if f[x+2] == 'arch' :
             # .../arch/$SIT_ARCH/geninc/Package/file
-            trace ( 'Child comes from %s' % f[x-1], '_guessPackage', 8 )
+            trace ( 'Child comes from %s', '_guessPackage', 8, f[x-1] )
             return f[x-1]
     except :
         pass
@@ -171,9 +133,226 @@ def _guessPackage ( path ):
     if len(f) > 2 and f[2] == 'include' :
 
         # .../include/Package/file
-        trace ( 'Child comes from %s' % f[1], '_guessPackage', 8 )
+        trace ( 'Child comes from %s', '_guessPackage', 8, f[1] )
         return f[1]
 
+#
+# Resolver for the package names of the include files. Known include roots
+# (arch/$SIT_ARCH/geninc and include in every repository, plus include
+# directory of the conda environment) are stored in a prefix trie keyed by
+# path components so that a lookup costs O(path depth). Results are memoized
+# per path, paths outside of known roots are handled by _guessPackage().
+#
+_GENINC = 'geninc'
+_INCLUDE = 'include'
+_CONDA = 'conda'
+
+class _PackageResolver(object):
+
+    def __init__(self, env):
+
+        self._trie = {}
+        self._cache = {}
+
+        sit_arch = env['SIT_ARCH']
+        top = env.Dir('#').abspath
+        for r in ['#'] + env['SIT_REPOS'] :
+            if r == '#' :
+                # local files are known by their path relative to top directory
+                bases = ['', top]
+            else :
+                bases = [r]
+            for base in bases :
+                self._addRoot ( os.path.join(base, "arch", sit_arch, "geninc"), _GENINC )
+                self._addRoot ( os.path.join(base, "include"), _INCLUDE )
+        if env['CONDA'] :
+            self._addRoot ( os.path.join(env['CONDA_ENV_PATH'], 'include'), _CONDA )
+
+    def _addRoot(self, root, kind):
+        trace ( 'include root %s: %s' % (kind, root), '_PackageResolver', 4 )
+        node = self._trie
+        for c in os.path.normpath(root).split(os.sep) :
+            node = node.setdefault(c, {})
+        node[None] = kind
+
+    def _lookup(self, f):
+        """Returns the kind of the longest matching root and path components after it"""
+        node = self._trie
+        kind, depth = None, 0
+        for i, c in enumerate(f) :
+            node = node.get(c)
+            if node is None : break
+            if None in node : kind, depth = node[None], i+1
+        return kind, f[depth:]
+
+    def guess(self, path):
+        """Returns package name for the include file path or None"""
+        try:
+            return self._cache[path]
+        except KeyError:
+            pass
+
+        kind, rest = self._lookup ( path.split(os.sep) )
+        pkg = None
+        if kind == _GENINC :
+            pkg = self._guessGeninc ( rest )
+        elif kind == _INCLUDE :
+            # .../include/Package/file
+            if len(rest) == 2 : pkg = rest[0]
+        elif kind == _CONDA :
+            pkg = self._guessConda ( rest )
+        if pkg is None :
+            pkg = _guessPackage ( path )
+        trace ( 'Child %s comes from %s', '_PackageResolver', 8, path, pkg )
+
+        self._cache[path] = pkg
+        return pkg
+
+    def _guessGeninc(self, rest):
+        # .../arch/$SIT_ARCH/geninc/Package/file
+        if not rest : return None
+        if rest[0] == 'boost' and len(rest) > 1 :
+            # .../arch/$SIT_ARCH/geninc/boost/.....
+            return _guessBoostPackage ( rest[1] )
+        if rest[0] == 'pdsdata' and len(rest) > 2 :
+            # .../arch/$SIT_ARCH/geninc/pdsdata/package/File
+            if rest[1] == 'xtc' : return 'pdsdata'
+            return 'pdsdata_' + rest[1]
+        return rest[0]
+
+    def _guessConda(self, rest):
+        # $CONDA_ENV_PATH/include/...
+        if len(rest) == 1 :
+            if rest[0] in ['hdf5.h', 'hdf5_hl.h'] : return 'hdf5'
+            # we assume openmpi provides the mpi implementation in the conda environments
+            if rest[0] == 'mpi.h' : return 'openmpi'
+            return None
+        if len(rest) > 1 :
+            if rest[0] == 'pdsdata' :
+                if rest[1] == 'xtc' : return 'pdsdata'
+                return 'pdsdata_' + rest[1]
+            if rest[0] == 'boost' :
+                return _guessBoostPackage ( rest[1] )
+        return None
+
+#
+# Walks the SCons dependency graph below a node and collects the names of
+# the packages whose include files appear there. The walk is memoized: every
+# node is expanded at most once per instance and the set of packages found
+# below it is cached, so the headers shared between many libraries and
+# binaries are only looked at once.
+#
+class _DepsFinder(object):
+
+    def __init__(self, resolver=None):
+        if resolver is None : resolver = _PackageResolver(DefaultEnvironment())
+        self._resolver = resolver
+        self._cache = {}
+        self._inputs = {}
+        self._libs = None
+        self.visited = 0
+        self.hits = 0
+        self.elapsed = 0.
+
+    def find(self, node, top=False):
+        """
+        Returns the set of packages below given node, the set is shared, do not modify it.
+        Top-level targets (libraries and binaries) are not scanned, only their sources,
+        explicit dependencies and libraries of this release given in their LIBS are
+        followed; their implicit dependencies depend on the libraries which are added
+        after this.
+        """
+
+        try:
+            res = self._cache[node]
+            self.hits += 1
+            return res
+        except KeyError:
+            pass
+
+        self.visited += 1
+        res = self._cache[node] = set()
+        inputs = self._inputs[node] = set()
+        if top:
+            children = node.sources + node.depends
+        else:
+            children = node.children() + self._includedSources(node)
+        for child in children :
+            # take all children which are include files, i.e. they live in
+            # .../arch/${SIT_ARCH}/genarch/Package/ or include/Package/ directory
+            f = str(child)
+            trace ( 'Checking child %s', 'findAllDependencies', 8, f )
+            p = self._resolver.guess ( f )
+            if p :
+                res.add ( p )
+            res.update ( self.find(child) )
+            # remember source files, their changes can change the packages;
+            # below top level also generated sources and headers, they are
+            # only scanned once made and are rescanned when remade
+            if isinstance(child, SCons.Node.FS.Base) :
+                if not child.has_builder() :
+                    inputs.add ( str(child.srcnode()) )
+                elif not top :
+                    inputs.add ( str(child) )
+            inputs.update ( self._inputs[child] )
+
+        # scanning the target used to find these libraries through LIBS, the
+        # packages they need are needed by the target too
+        if top:
+            for lib in self._localLibs(node) :
+                if lib is node : continue
+                res.update ( self.find(lib, top=True) )
+                inputs.update ( self._inputs[lib] )
+
+        return res
+
+    def _includedSources(self, node):
+        """
+        Generated sources (unity files) list the files which they include,
+        SCons only scans generated files after they are made so these
+        files are scanned here with the scanner of the node
+        """
+        res = []
+        for src in node.sources :
+            included = getattr(src.attributes, 'included_sources', None)
+            if not included : continue
+            executor = node.get_executor()
+            env = executor.get_build_env()
+            for inc in included :
+                res.append ( inc )
+                res.extend ( inc.get_implicit_deps(env, node.builder.source_scanner, executor.get_build_scanner_path) )
+        return res
+
+    def _localLibs(self, node):
+        """Libraries built in this release which are named in LIBS of the target"""
+        if node.env is None : return []
+        if self._libs is None :
+            self._libs = {}
+            for pkg, libs in DefaultEnvironment()['PKG_TREE_LIB'].items() :
+                for lib in libs : self._libs[lib.name] = lib
+        prefix = node.env.subst('$SHLIBPREFIX')
+        suffix = node.env.subst('$SHLIBSUFFIX')
+        res = []
+        for name in node.env.get('LIBS', []) :
+            if isinstance(name, six.string_types) and prefix+name+suffix in self._libs :
+                res.append ( self._libs[prefix+name+suffix] )
+        return res
+
+    def scan(self, node):
+        """Same as find() but also accumulates time spent in self.elapsed"""
+        t0 = time.time()
+        try:
+            return self.find(node, top=True)
+        finally:
+            self.elapsed += time.time() - t0
+
+    def inputs(self, node):
+        """Returns the set of source files below the node, call after find()"""
+        return self._inputs[node]
+
+    def report(self):
+        trace ( 'Dependency scan visited %d nodes, %d cache hits, %.2f sec' % (self.visited, self.hits, self.elapsed), 'adjustPkgDeps', 1 )
+
 #
 # Returns the list of all packages that given node depends upon.
 # Only direct dependencies are evaluated. Analyzes all SCons children
@@ -182,18 +361,7 @@ def _guessPackage ( path ):
 #
 def findAllDependencies( node ):
 
-    res = set()
-    for child in node.children() :
-        # take all children which are include files, i.e. they live in
-        # .../arch/${SIT_ARCH}/genarch/Package/ or include/Package/ directory
-        f = str(child)
-        trace ( 'Checking child %s' % f, 'findAllDependencies', 8 )
-        p = _guessPackage ( f )
-        if p :
-            res.add ( p )
-        res.update ( findAllDependencies(child) )
-
-    return res
+    return set(_DepsFinder().find(node))
 
 #
 # Define package libraries - everything that has to be linked to application
@@ -236,62 +404,498 @@ def setPkgDeps ( pkg, deps ):
     if deps :
         pkg_info = env['PKG_TREE'].setdefault( pkg, {} )
         if isinstance(deps,(six.binary_type,six.text_type)) : deps = deps.split()
-        # do not include self-dependencies
-        pkg_info['DEPS'] = [ d for d in deps if d != pkg ]
-        trace("setPkgDeps: pkg=%s deps=%s" % (pkg, ','.join(pkg_info['DEPS'])), "dependencies", 3)
+        # do not include self-dependencies, sorted so that the link order
+        # does not depend on the set order
+        pkg_info['DEPS'] = [ d for d in sorted(deps) if d != pkg ]
+        trace("setPkgDeps: pkg=%s deps=%s", "dependencies", 3, pkg, lazyList(pkg_info['DEPS']))
 
 #
-# Store package dependency data in a file
+# Store package dependency data in a file, compact format is used unless
+# the tree has something it cannot represent
 #
 def storePkgDeps ( fileName ):
 
     env = DefaultEnvironment()
     trace ( 'Storing release dependencies in file %s' % fileName, 'storePkgDeps', 2 )
-    f = open ( fileName, 'wb' )
-    pickle.dump( env['PKG_TREE'], f )
-    f.close()
+    try:
+        writePkgTree ( fileName, env['PKG_TREE'] )
+    except ValueError as e:
+        trace ( 'Cannot use compact format (%s), storing pickle' % e, 'storePkgDeps', 1 )
+        f = open ( fileName, 'wb' )
+        pickle.dump( env['PKG_TREE'], f )
+        f.close()
 
 #
-# Restore package dependency data from a file
+# Restore package dependency data from a file, package records from
+# compact files are decoded only when they are used
 #
 def loadPkgDeps ( fileName  ):
 
     env = DefaultEnvironment()
     trace ( 'Loading release dependencies from file %s' % fileName, 'loadPkgDeps', 2 )
-    f = open ( fileName, 'rb' )
-    env['PKG_TREE_BASE'].update( pickle.load( f ) )
-    f.close()
+    env['PKG_TREE_BASE'].update( readPkgTree( fileName ) )
 
 #
-# generator method for DFS scan of dependency tree
+# Restore package dependency data from the files of all base releases. The
+# merged tree is cached in compact format in cacheFile together with the
+# list of files, their modification times and sizes; if none of the files
+# changed only the cache file is read.
+#
+def loadBasePkgDeps ( fileNames, cacheFile ):
+
+    env = DefaultEnvironment()
+    if not fileNames: return
+
+    key = []
+    for fileName in fileNames:
+        st = os.stat(fileName)
+        key.append([os.path.abspath(fileName), st.st_mtime, st.st_size])
+    key = json.dumps(key).encode('utf-8')
+
+    if os.path.isfile(cacheFile):
+        try:
+            tree = PkgTreeFile(cacheFile)
+            if tree.metadata == key:
+                trace ( 'Loading merged release dependencies from file %s' % cacheFile, 'loadPkgDeps', 2 )
+                env['PKG_TREE_BASE'].update( tree )
+                return
+        except (ValueError, EnvironmentError, struct.error) as e:
+            trace ( 'Failed to read merged release dependencies %s: %s' % (cacheFile, e), 'loadPkgDeps', 1 )
+
+    for fileName in fileNames:
+        loadPkgDeps ( fileName )
+
+    trace ( 'Storing merged release dependencies in file %s' % cacheFile, 'loadPkgDeps', 2 )
+    try:
+        d = os.path.dirname(cacheFile)
+        if d and not os.path.isdir(d): os.makedirs(d)
+        tree = dict((pkg, dict(info)) for pkg, info in env['PKG_TREE_BASE'].items())
+        writePkgTree ( cacheFile, tree, key )
+    except (ValueError, EnvironmentError) as e:
+        trace ( 'Failed to store merged release dependencies %s: %s' % (cacheFile, e), 'loadPkgDeps', 1 )
+
+#
+# Exception for the cycles in the package dependencies, message lists all of them
 #
 class _CycleError ( Exception ) :
-    def __init__ (self, pkg1, pkg2):
-        Exception.__init__ ( self, "Dependency cycle detected between packages "+pkg1+" and "+pkg2 )
+    def __init__ (self, cycles):
+        self.cycles = cycles
+        msg = "Dependency cycles detected between packages:"
+        for c in cycles :
+            msg += "\n    " + " -> ".join(c)
+        Exception.__init__ ( self, msg )
 
-_WHITE = 0
-_GRAY = 1
-_BLACK = 2
-def _toposort ( pkg_tree, pkg, colors ):
+#
+# Strongly connected components of the package graph reachable from the
+# roots, non-recursive version of Tarjan's algorithm. Components are returned
+# in reverse topological order, dependencies before the packages which need
+# them; in the graph without cycles every component is a single package.
+#
+def _sccs ( pkg_tree, roots ):
+
+    def deps(pkg) :
+        return pkg_tree.get(pkg,{}).get('DEPS',[])
+
+    index = {}
+    low = {}
+    stack = []
+    onstack = set()
+    result = []
+
+    for root in roots :
+        if root in index : continue
+
+        index[root] = low[root] = len(index)
+        stack.append ( root )
+        onstack.add ( root )
+        work = [ (root, iter(deps(root))) ]
+        while work :
+            v, adj = work[-1]
+            for w in adj :
+                if w not in index :
+                    # descend into w, continue with v later
+                    index[w] = low[w] = len(index)
+                    stack.append ( w )
+                    onstack.add ( w )
+                    work.append ( (w, iter(deps(w))) )
+                    break
+                elif w in onstack :
+                    low[v] = min(low[v], index[w])
+            else :
+                # all successors of v are done
+                work.pop()
+                if work :
+                    u = work[-1][0]
+                    low[u] = min(low[u], low[v])
+                if low[v] == index[v] :
+                    comp = []
+                    while True :
+                        w = stack.pop()
+                        onstack.discard ( w )
+                        comp.append ( w )
+                        if w == v : break
+                    result.append ( comp )
+
+    return result
 
-    colors[pkg] = _GRAY
+#
+# Returns one cycle going through the packages of the component as a list
+# of package names, first package is repeated at the end. Returns None if
+# component is a single package which does not depend on itself.
+#
+def _findCycle ( pkg_tree, comp ):
+
+    members = set(comp)
+    start = min(comp)
+    # breadth-first search inside the component for the path back to start
+    parent = {}
+    queue = [start]
+    for pkg in queue :
+        for d in pkg_tree.get(pkg,{}).get('DEPS',[]) :
+            if d == start :
+                path = [start]
+                while pkg != start :
+                    path.append ( pkg )
+                    pkg = parent[pkg]
+                path.append ( start )
+                path[1:-1] = reversed(path[1:-1])
+                return path
+            if d in members and d not in parent :
+                parent[d] = pkg
+                queue.append ( d )
+    return None
 
-    adj = pkg_tree.get(pkg,{}).get('DEPS',[])
-    for a in adj :
-        acol = colors.get(a,_WHITE)
-        if acol == _GRAY :
-            # means cycle
-            raise _CycleError ( pkg, a )
-        elif acol == _WHITE :
-            for c in _toposort ( pkg_tree, a, colors ) :
-                yield c
-    yield pkg
-    colors[pkg] = _BLACK
+#
+# Link order service for the binaries. Packages reachable from the given
+# roots in the merged package tree are checked for cycles once by _sccs(),
+# the ordered list of packages for a binary is the reversed post-order of
+# a depth-first walk from its direct dependencies, the walk visits every
+# package once. This is the order which separate walks from every direct
+# dependency gave, with only the last copy of repeated packages kept.
+#
+class _LinkOrder(object):
+
+    def __init__(self, pkg_tree, roots):
+
+        self._tree = pkg_tree
+
+        comps = _sccs ( pkg_tree, sorted(roots) )
+        cycles = [_findCycle(pkg_tree, comp) for comp in comps]
+        cycles = [c for c in cycles if c]
+        if cycles : raise _CycleError ( cycles )
+
+        trace ( 'Link order of %d packages' % len(comps), 'adjustPkgDeps', 2 )
+
+    def _deps(self, pkg):
+        return self._tree.get(pkg,{}).get('DEPS',[])
+
+    def order(self, pkgs):
+        """Returns de-duplicated list of packages needed by pkgs, packages come before their dependencies"""
+
+        visited = set()
+        order = []
+        for pkg in pkgs :
+            if pkg in visited : continue
+            # graph is acyclic, no need for gray color
+            visited.add ( pkg )
+            work = [ (pkg, iter(self._deps(pkg))) ]
+            while work :
+                p, adj = work[-1]
+                for d in adj :
+                    if d not in visited :
+                        visited.add ( d )
+                        work.append ( (d, iter(self._deps(d))) )
+                        break
+                else :
+                    work.pop()
+                    order.append ( p )
+        order.reverse()
+        return order
+
+#
+# Reads the source and include files of the targets on a pool of threads
+# before the serial dependency scan. SCons nodes are not thread-safe so they
+# are not touched by the threads, the threads only follow #include lines
+# through the CPPPATH directories and read the files. This fills operating
+# system caches for the scanners which run next, on the network file systems
+# waiting for these reads is most of the scanning time.
+#
+_includeRe = re.compile(r'^[ \t]*#[ \t]*(?:include|import)[ \t]*(<|")([^>"]+)(>|")', re.M)
+
+class _Prefetcher(object):
+
+    def __init__(self, nthreads):
+        self.nthreads = nthreads
+        self.files = 0
+        self.iotime = 0.
+        self.elapsed = 0.
+        self._seen = set()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+
+    def _cpppath(self, node):
+        """Absolute paths of CPPPATH directories for a built node, done in main thread"""
+        cwd = getattr(node, 'cwd', None)
+        dirs = []
+        for d in SCons.Scanner.FindPathDirs('CPPPATH')(node.env, cwd):
+            for p in [d.get_abspath(), d.srcnode().get_abspath()]:
+                if p not in dirs: dirs.append(p)
+        return tuple(dirs)
+
+    def _tasks(self, nodes):
+        """Generates (path, cpppath) for all source files of the nodes"""
+        seen = set()
+        stack = list(nodes)
+        while stack:
+            node = stack.pop()
+            if node in seen: continue
+            seen.add(node)
+            for src in node.sources:
+                if src.sources:
+                    stack.append(src)
+                elif node.env is not None and isinstance(src, SCons.Node.FS.File):
+                    yield src.srcnode().get_abspath(), self._cpppath(node)
+
+    def _add(self, path, cpppath):
+        with self._lock:
+            if path in self._seen: return
+            self._seen.add(path)
+        self._queue.put((path, cpppath))
+
+    def _read(self, path, cpppath):
+        t0 = time.time()
+        try:
+            f = open(path, 'rb')
+            data = f.read().decode('latin-1')
+            f.close()
+        except (IOError, OSError):
+            return
+        srcdir = os.path.dirname(path)
+        for q, name, q2 in _includeRe.findall(data):
+            dirs = (srcdir,) + cpppath if q == '"' else cpppath + (srcdir,)
+            for d in dirs:
+                inc = os.path.join(d, name)
+                if os.path.isfile(inc):
+                    self._add(os.path.normpath(inc), cpppath)
+                    break
+        with self._lock:
+            self.files += 1
+            self.iotime += time.time() - t0
+
+    def _worker(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                # sentinel from run(), all files are done
+                self._queue.task_done()
+                return
+            path, cpppath = task
+            try:
+                self._read(path, cpppath)
+            finally:
+                self._queue.task_done()
+
+    def run(self, nodes):
+        t0 = time.time()
+        threads = []
+        for i in range(self.nthreads):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for path, cpppath in self._tasks(nodes):
+            self._add(path, cpppath)
+        # workers add included files to the queue, so stop them only when it is drained
+        self._queue.join()
+        for t in threads: self._queue.put(None)
+        for t in threads: t.join()
+        self.elapsed = time.time() - t0
+
+    def report(self, scantime):
+        # reads overlapped with each other, the saving is not measured but
+        # estimated as the difference between read time and prefetch time
+        trace ( "Prefetched %d files with %d threads in %.2f sec (%.2f sec of reads), "
+                "dependency scan took %.2f sec, saved (estimate: reads - prefetch time) %.2f sec",
+                'adjustPkgDeps', 1, self.files, self.nthreads, self.elapsed, self.iotime,
+                scantime, max(0., self.iotime - self.elapsed) )
+
+#
+# Snapshot of the package dependencies computed by adjustPkgDeps() for every
+# library and binary. It is stored in a file between the runs, a target is
+# only rescanned when the list of its sources, its CPPPATH or any of the
+# source/include files below it changed (by modification time and size).
+# The link libraries are reused when the tree entries of all the packages
+# which contributed to them are the same.
+#
+class _DepsSnapshot(object):
+
+    _VERSION = 3
+
+    def __init__(self, fileName):
+
+        self.fileName = fileName
+        self.reused = 0
+        self.rescanned = 0
+        self._stats = {}
+        self._targets = {}
+
+        old = {}
+        if fileName and os.path.isfile(fileName):
+            try:
+                f = open(fileName, 'rb')
+                old = pickle.load(f)
+                f.close()
+            except Exception as e:
+                trace ( 'Failed to read dependency snapshot %s: %s' % (fileName, e), 'adjustPkgDeps', 1 )
+                old = {}
+        if not isinstance(old, dict) or old.get('VERSION') != self._VERSION: old = {}
+        self._oldFiles = old.get('FILES', {})
+        self._oldTargets = old.get('TARGETS', {})
+
+    def _stat(self, path):
+        try:
+            return self._stats[path]
+        except KeyError:
+            pass
+        try:
+            st = os.stat(path)
+            sig = (st.st_mtime, st.st_size)
+        except OSError:
+            sig = None
+        self._stats[path] = sig
+        return sig
+
+    def _key(self, node):
+        """Things which define the scan result besides the content of the files"""
+        srcs = set()
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            if n.sources:
+                stack.extend(n.sources)
+            else:
+                srcs.add(str(n))
+        cpppath = node.env.get('CPPPATH', []) if node.env else []
+        # local libraries in LIBS are followed by the scan
+        libs = node.env.get('LIBS', []) if node.env else []
+        return (tuple(sorted(srcs)), tuple(map(str, cpppath)), tuple(map(str, libs)))
+
+    def get(self, node):
+        """Returns the record for the node, new one if the node needs to be rescanned"""
+
+        name = str(node)
+        key = self._key(node)
+        rec = self._oldTargets.get(name)
+        if rec is not None and rec['KEY'] == key:
+            for path in rec['INPUTS']:
+                if path not in self._oldFiles or self._stat(path) != self._oldFiles[path]:
+                    break
+            else:
+                self.reused += 1
+                self._targets[name] = rec
+                return rec
+
+        self.rescanned += 1
+        rec = self._targets[name] = dict(KEY=key)
+        return rec
+
+    def save(self):
+
+        if not self.fileName: return
+
+        files = {}
+        for rec in self._targets.values():
+            for path in rec.get('INPUTS', []):
+                files[path] = self._stat(path)
+        data = dict(VERSION=self._VERSION, FILES=files, TARGETS=self._targets)
+
+        trace ( 'Storing dependency snapshot in file %s' % self.fileName, 'adjustPkgDeps', 2 )
+        try:
+            d = os.path.dirname(self.fileName)
+            if d and not os.path.isdir(d): os.makedirs(d)
+            tmp = self.fileName + '.tmp'
+            f = open(tmp, 'wb')
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            f.close()
+            os.rename(tmp, self.fileName)
+        except (IOError, OSError) as e:
+            trace ( 'Failed to store dependency snapshot %s: %s' % (self.fileName, e), 'adjustPkgDeps', 1 )
+
+    def report(self):
+        trace ( 'Dependency snapshot: %d targets reused, %d rescanned' % (self.reused, self.rescanned), 'adjustPkgDeps', 1 )
+
+#
+# Signature of the package tree entries, used to check whether link
+# libraries computed from these packages are still valid
+#
+def _treeSignature ( pkg_tree, pkgs ):
+    res = []
+    for p in pkgs:
+        info = pkg_tree.get(p, {})
+        res.append((p, tuple(info.get('DEPS', [])), tuple(info.get('LIBS', [])), tuple(info.get('LIBDIRS', []))))
+    return res
+
+#
+# Name of the python library in the given directory, Python 3.8 and beyond
+# dropped extra 'm' from the name. Resolved once for each directory.
+#
+_pythonLibs = {}
+
+def _pythonLib ( libdir ):
+    pystr = "python%d.%d"%(sys.version_info.major, sys.version_info.minor)
+    if libdir not in _pythonLibs:
+        if glob.glob(os.path.join(libdir, "lib"+pystr+".so*")):
+            _pythonLibs[libdir] = pystr
+        else:
+            _pythonLibs[libdir] = pystr + 'm'
+        trace ( "python library in "+libdir+" is "+_pythonLibs[libdir], "adjustPkgDeps", 2 )
+    return _pythonLibs[libdir]
+
+#
+# Remove repeated libraries and library directories from the link line.
+# For libraries the last occurrence is kept so that every library still
+# comes after all libraries which need it, for directories the first one
+# is kept as it is the one that linker uses. Lists are updated in place
+# as they can be shared between targets of the same package.
+#
+def _normalizeLinkLine ( env ):
+
+    libs = env.get('LIBS')
+    if isinstance(libs, list):
+        pystr = "python%d.%d"%(sys.version_info.major, sys.version_info.minor)
+        if pystr in libs:
+            pylib = _pythonLib ( env['PYTHON_LIBDIR'] )
+            libs = [l if l != pystr else pylib for l in libs]
+        seen = set()
+        res = []
+        for l in reversed(libs):
+            key = str(l)
+            if key not in seen:
+                seen.add(key)
+                res.append(l)
+        res.reverse()
+        env['LIBS'][:] = res
+
+    libpath = env.get('LIBPATH')
+    if isinstance(libpath, list):
+        seen = set()
+        res = []
+        for d in libpath:
+            key = str(d)
+            if key not in seen:
+                seen.add(key)
+                res.append(d)
+        libpath[:] = res
 
 #
 # analyze complete dependency tree and adjust dependencies and libs
 #
-def adjustPkgDeps():
+# Dependency cycles are only looked for among the packages reachable from
+# the direct dependencies of binaries, and only when link order of some
+# binary has to be recomputed; cycles between libraries which no binary
+# uses are not reported. A cycle fails the build.
+#
+def adjustPkgDeps(snapshotFile=None):
 
     env = DefaultEnvironment()
 
@@ -301,12 +905,32 @@ def adjustPkgDeps():
     pkg_tree = env['PKG_TREE_BASE'].copy()
     pkg_tree.update( env['PKG_TREE'] )
 
+    # one finder for all libraries and binaries, they share most of the headers
+    finder = _DepsFinder()
+
+    # results of the previous run, if any
+    snapshot = _DepsSnapshot(snapshotFile)
+
+    # snapshot records for all libraries and binaries
+    librecs = [(pkg, lib, snapshot.get(lib)) for pkg, libs in env['PKG_TREE_LIB'].items() for lib in libs]
+    binrecs = [(bin, snapshot.get(bin)) for pkg, bins in env['PKG_TREE_BINS'].items() for bin in bins]
+
+    # read files of the targets which need to be scanned in parallel
+    prefetcher = None
+    nthreads = int(env.get('SCAN_THREADS', 0))
+    if nthreads > 0:
+        prefetcher = _Prefetcher(nthreads)
+        prefetcher.run([lib for pkg, lib, rec in librecs if 'PKGS' not in rec] +
+                       [bin for bin, rec in binrecs if 'PKGS' not in rec])
+
     # evaluate package dependencies for libraries
-    for pkg, libs in env['PKG_TREE_LIB'].items() :
-        for lib in libs:
+    for pkg, lib, rec in librecs :
 
-            trace ( "checking dependencies for library "+str(lib), "adjustPkgDeps", 4 )
-            deps = findAllDependencies ( lib )
+            trace ( "checking dependencies for library %s", "adjustPkgDeps", 4, lib )
+            if 'PKGS' not in rec:
+                rec['PKGS'] = sorted(finder.scan(lib))
+                rec['INPUTS'] = sorted(finder.inputs(lib))
+            deps = set(rec['PKGS'])
             # self-dependencies are not needed here
             deps.discard(pkg)
 
@@ -317,71 +941,68 @@ def adjustPkgDeps():
             # does not need mysql client library
             if pkg == "RdbMySQL": deps.discard("mysql")
 
-            trace ( "package "+pkg+" deps = " + str(list(map(str,deps))), "adjustPkgDeps", 4 )
+            trace ( "package %s deps = %s", "adjustPkgDeps", 4, pkg, lazyList(deps) )
             setPkgDeps ( pkg, deps )
 
             # add all libraries from the packages
-            for d in deps :
-                libs = pkg_tree.get(d,{}).get( 'LIBS', [] )
-                lib.env['LIBS'].extend ( libs )
-            trace ( str(lib)+" libs = " + str(list(map(str,lib.env['LIBS']))), "adjustPkgDeps", 4 )
-
-            #
-            # This is a hack to tell scons to rescan the library, otherwise
-            # it can decide in some cases that it has been scanned already
-            # and won't scan it again, and the libraries that we have just
-            # added will not be in the dependency list which can result in
-            # the unnecessary rebuilding of the binary
-            #
-            if lib.env['LIBS'] :
-                lib.implicit = None
-
-	    # Handle python libraries with extra 'm'. Python 3.8 and beyond dropped this
-            pystr = "python%d.%d"%(sys.version_info.major, sys.version_info.minor)
-            if pystr in lib.env['LIBS']:
-                LIBDIR  = lib.env['PYTHON_LIBDIR']
-                if not glob.glob(os.path.join(LIBDIR, "lib"+pystr+".so*")):
-                    lib.env['LIBS'] = [l if l != pystr else pystr + 'm' for l in lib.env['LIBS']]
-
-    # iterate over all binaries
-    for pkg, bins in env['PKG_TREE_BINS'].items() :
-        for bin in bins :
-
-            trace ( "checking dependencies for binary "+str(bin), "adjustPkgDeps", 4 )
-            bindeps = findAllDependencies ( bin )
+            tree = _treeSignature ( pkg_tree, sorted(deps) )
+            if rec.get('TREE') != tree:
+                rec['TREE'] = tree
+                rec['LIBS'] = []
+                for d in sorted(deps) :
+                    rec['LIBS'].extend ( pkg_tree.get(d,{}).get( 'LIBS', [] ) )
+            lib.env['LIBS'].extend ( rec['LIBS'] )
+            _normalizeLinkLine ( lib.env )
+            trace ( "%s libs = %s", "adjustPkgDeps", 4, lib, lazyList(lib.env['LIBS']) )
+
+    # direct dependencies of all binaries
+    for bin, rec in binrecs :
+        trace ( "checking dependencies for binary %s", "adjustPkgDeps", 4, bin )
+        if 'PKGS' not in rec:
+            rec['PKGS'] = sorted(finder.scan(bin))
+            rec['INPUTS'] = sorted(finder.inputs(bin))
+
+    # one ordering of the package tree for all binaries, only made when needed
+    linkOrder = None
+
+    for bin, rec in binrecs :
+
+        # ordered list of all dependencies is still good if none of
+        # the packages in it changed their dependencies or libraries
+        alldeps = rec.get('ALLDEPS')
+        if alldeps is None or rec.get('TREE') != _treeSignature ( pkg_tree, alldeps ):
+
+            if linkOrder is None:
+                roots = set()
+                for b, r in binrecs: roots.update(r['PKGS'])
+                try:
+                    linkOrder = _LinkOrder ( pkg_tree, roots )
+                except _CycleError as e:
+                    fail ( str(e) )
 
             # build ordered list of all dependencies
-            alldeps = []
-            for d in bindeps :
-                for c in _toposort( pkg_tree, d, {} ) :
-                    alldeps.append ( c )
-            alldeps.reverse()
-
-            # now get all their libraries and add to the binary
-            trace ( str(bin)+" deps = " + str(list(map(str,alldeps))), "adjustPkgDeps", 4 )
+            alldeps = linkOrder.order ( rec['PKGS'] )
+
+            rec['ALLDEPS'] = alldeps
+            rec['TREE'] = _treeSignature ( pkg_tree, alldeps )
+            rec['LIBS'] = []
+            rec['LIBPATH'] = []
             for d in alldeps :
-                libs = pkg_tree.get(d,{}).get( 'LIBS', [] )
-                libpath = pkg_tree.get(d,{}).get( 'LIBDIRS', [] )
-                bin.env['LIBS'].extend ( libs )
-                bin.env['LIBPATH'].extend ( libpath )
-            trace ( str(bin)+" libs = " + str(list(map(str,bin.env['LIBS']))), "adjustPkgDeps", 4 )
-
-            #
-            # This is a hack to tell scons to rescan the binary, otherwise
-            # it can decide in some cases that it has been scanned already
-            # and won't scan it again, and the libraries that we have just
-            # added will not be in the dependency list which can result in
-            # the unnecessary rebuilding of the binary
-            #
-            if bin.env['LIBS'] :
-                bin.implicit = None
-
-	    # Handle python libraries with extra 'm'. Python 3.8 and beyond dropped this
-            pystr = "python%d.%d"%(sys.version_info.major, sys.version_info.minor)
-            if pystr in bin.env['LIBS']:
-                LIBDIR  = bin.env['PYTHON_LIBDIR']
-                if not glob.glob(os.path.join(LIBDIR, "lib"+pystr+".so*")):
-                    bin.env['LIBS'] = [l if l != pystr else pystr + 'm' for l in bin.env['LIBS']]
+                rec['LIBS'].extend ( pkg_tree.get(d,{}).get( 'LIBS', [] ) )
+                rec['LIBPATH'].extend ( pkg_tree.get(d,{}).get( 'LIBDIRS', [] ) )
+
+        # now get all their libraries and add to the binary
+        trace ( "%s deps = %s", "adjustPkgDeps", 4, bin, lazyList(alldeps) )
+        env['PKG_TREE_BINDEPS'][bin] = alldeps
+        bin.env['LIBS'].extend ( rec['LIBS'] )
+        bin.env['LIBPATH'].extend ( rec['LIBPATH'] )
+        _normalizeLinkLine ( bin.env )
+        trace ( "%s libs = %s", "adjustPkgDeps", 4, bin, lazyList(bin.env['LIBS']) )
+
+    finder.report()
+    if prefetcher: prefetcher.report(finder.elapsed)
+    snapshot.report()
+    snapshot.save()
 
 
 class PrintDependencies(object):
@@ -408,3 +1029,82 @@ class PrintDependencies(object):
         for pkg in sorted(deptree.keys()):
             deps = sorted(deptree[pkg])
             print(pkg, "->", ' '.join(deps))
+
+
+class DependencyIndex(object):
+    """Reverse dependency index of the package tree, answers 'what is affected if these packages change'"""
+
+    def __init__(self, trees):
+        """Constructor takes the list of trees"""
+        self.tree = {}
+        for tree in trees:
+            self.tree.update(tree)
+        self.rdeps = {}
+        for pkg in self.tree:
+            for dep in self.tree[pkg].get('DEPS', []):
+                self.rdeps.setdefault(dep, set()).add(pkg)
+
+    def dependents(self, pkgs):
+        """Returns the set of given packages and all packages which depend on them directly or indirectly"""
+        res = set(pkgs)
+        queue = list(res)
+        while queue:
+            pkg = queue.pop()
+            for r in self.rdeps.get(pkg, ()):
+                if r not in res:
+                    res.add(r)
+                    queue.append(r)
+        return res
+
+    def impact(self, pkgs, env):
+        """Returns dictionary with affected packages, libraries, binaries and unit tests"""
+
+        affected = self.dependents(pkgs)
+
+        libs = []
+        for pkg, pkglibs in env['PKG_TREE_LIB'].items():
+            if pkg in affected:
+                libs += [str(lib) for lib in pkglibs]
+
+        bins = set()
+        for pkg, pkgbins in env['PKG_TREE_BINS'].items():
+            for bin in pkgbins:
+                if pkg in affected or affected.intersection(env['PKG_TREE_BINDEPS'].get(bin, [])):
+                    bins.add(bin)
+
+        tests = []
+        for t in env['ALL_TARGETS']['TESTS']:
+            if not str(t).endswith('.utest'): continue
+            pkg = os.path.basename(os.path.split(str(t))[0])
+            if pkg in affected or bins.intersection(t.sources):
+                tests.append(str(t))
+
+        return dict(packages=sorted(affected),
+                    libraries=sorted(libs),
+                    binaries=sorted(map(str, bins)),
+                    tests=sorted(tests))
+
+
+class PackageImpact(object):
+    """Action which prints targets affected by the change in a set of packages"""
+
+    # do not print anything when action is executed, output may be JSON
+    strfunction = None
+
+    def __init__(self, trees, pkgs, format='text'):
+        """Constructor takes the list of trees, list of changed packages and output format"""
+        self.trees = trees
+        self.pkgs = pkgs
+        self.format = format
+
+    def __call__(self, target, source, env):
+
+        res = DependencyIndex(self.trees).impact(self.pkgs, env)
+
+        if self.format == 'json':
+            print(json.dumps(res, indent=2, sort_keys=True))
+        else:
+            for key in ['packages', 'libraries', 'binaries', 'tests']:
+                print(key + ":")
+                for name in res[key]:
+                    print("    " + name)
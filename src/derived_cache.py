@@ -0,0 +1,242 @@
+#===============================================================================
+#
+# Shared cache of derived files with size limit
+#
+# $Id$
+#
+#===============================================================================
+
+"""
+Derived-file cache shared between releases and users which build with the
+same SIT_ARCH, configured with CACHE_DIR and CACHE_SIZE options. This is
+SCons CacheDir (files are keyed on their build signature which includes
+the action and the signatures of all sources) with these additions:
+
+  - only compilation products are cached: object files, libraries,
+    executables, extension modules, precompiled headers, Cython outputs
+    and .pyc files; installed copies and symlinks are not
+  - nothing is cached in environments which compile with -gsplit-dwarf,
+    objects have their debug info in .dwo files which CacheDir does not
+    know about
+  - every retrieval updates mtime of the cached file, and at exit the
+    least recently used files are removed when the cache is over the
+    size limit; removal is done under a lock so only one build at a time
+    does it
+  - cache size is kept in a file and increased by every build by the size
+    of files it added, the cache directory is only scanned when that
+    estimate goes over the limit or the last scan is older than a day
+  - hit and miss counts are printed at exit
+
+Files are added to the cache by renaming complete temporary files, so
+concurrent builds never see partial files. Cache directory has to be
+writable by all its users, e.g. group-writable with setgid bit.
+"""
+from __future__ import print_function
+
+import os
+import stat
+import time
+import fcntl
+import atexit
+import threading
+
+import SCons.Errors
+import SCons.CacheDir
+
+from SConsTools.scons_functions import fail
+
+# builders whose targets are cached
+_cachedBuilders = set(['SharedObject', 'StaticObject', 'Object', 'PythonObject', 'SharedLibrary',
+                       'Program', 'LoadableModule', 'PythonExtension', 'Pch', 'SharedPch',
+                       'Cython', 'CFile', 'CXXFile', 'PyCompile'])
+
+# cache is trimmed to this fraction of the limit so that it is not done on every build
+_trimFraction = 0.9
+
+# cache directory is scanned at least this often (seconds) even if size
+# estimate is below the limit, the estimate misses files added by builds
+# which could not get the lock and the files removed by other means
+_scanInterval = 24*3600
+
+_LOCK_FILE = '.lock'
+_SIZE_FILE = '.size'
+
+
+def parseSize(size):
+    """Convert size like 500M, 20gb or 100B to bytes, 0 means unlimited, raises ValueError"""
+    size = str(size).strip().upper()
+    if size.endswith('B'): size = size[:-1]
+    if not size: return 0
+    mult = 1
+    for i, unit in enumerate('KMGT'):
+        if size.endswith(unit):
+            size = size[:-1]
+            mult = 1024**(i+1)
+            break
+    return int(float(size) * mult)
+
+
+def _cacheable(node):
+    """True if node is made by one of the cached builders without split DWARF"""
+    try:
+        env = node.get_build_env()
+        if node.get_builder().get_name(env) not in _cachedBuilders: return False
+    except Exception:
+        return False
+    return '-gsplit-dwarf' not in str(env.get('CCFLAGS', ''))
+
+
+class DerivedFileCache(SCons.CacheDir.CacheDir):
+    """CacheDir which caches only compilation products and counts hits and misses"""
+
+    # counters are shared by all instances (each environment may have its own)
+    _lock = threading.Lock()
+    requests = 0
+    hits = 0
+    pushes = 0
+    pushedBytes = 0
+
+    def __init__(self, path):
+        SCons.CacheDir.CacheDir.__init__(self, path)
+
+    @classmethod
+    def _count(cls, name, n=1):
+        with cls._lock:
+            setattr(cls, name, getattr(cls, name) + n)
+
+    def retrieve(self, node):
+        if not _cacheable(node): return False
+        self._count('requests')
+        try:
+            res = SCons.CacheDir.CacheDir.retrieve(self, node)
+        except (EnvironmentError, SCons.Errors.BuildError):
+            # file may have been evicted by other build just now
+            res = False
+        if res: self._count('hits')
+        return res
+
+    def push(self, node):
+        if not _cacheable(node): return
+        res = SCons.CacheDir.CacheDir.push(self, node)
+        self._count('pushes')
+        try:
+            self._count('pushedBytes', os.path.getsize(node.get_abspath()))
+        except OSError:
+            pass
+        return res
+
+    def push_if_forced(self, node):
+        if not _cacheable(node): return
+        return SCons.CacheDir.CacheDir.push_if_forced(self, node)
+
+
+def _readSize(path):
+    """Returns (size estimate, time of last scan) from size file, or None"""
+    try:
+        f = open(os.path.join(path, _SIZE_FILE))
+        try:
+            size, scanTime = f.read().split()
+        finally:
+            f.close()
+        return int(size), float(scanTime)
+    except (EnvironmentError, ValueError):
+        return None
+
+
+def _writeSize(path, size, scanTime):
+    fname = os.path.join(path, _SIZE_FILE)
+    tmp = "%s.%d" % (fname, os.getpid())
+    try:
+        f = open(tmp, 'w')
+        f.write("%d %f\n" % (size, scanTime))
+        f.close()
+        os.rename(tmp, fname)
+    except EnvironmentError:
+        pass
+
+
+def trimCache(path, limit, added=0):
+    """
+    Remove least recently used files until cache is below the limit,
+    added is the size of files added by this build. Cache is only scanned
+    when size estimate is over the limit or the last scan is too old.
+    Returns (number of files, bytes) removed or None if the cache is
+    locked by other process or the lock cannot be opened.
+    """
+    try:
+        lock = open(os.path.join(path, _LOCK_FILE), 'a')
+    except EnvironmentError:
+        # e.g. lock file of other user which is not writable for us
+        return None
+    try:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return None
+
+        now = time.time()
+        rec = _readSize(path)
+        if rec is not None and rec[0] + added <= limit and now - rec[1] < _scanInterval:
+            _writeSize(path, rec[0] + added, rec[1])
+            return 0, 0
+
+        files = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in filenames:
+                if dirpath == path: continue   # config and lock files
+                fname = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(fname)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(st.st_mode) and not stat.S_ISLNK(st.st_mode): continue
+                files.append((st.st_mtime, st.st_size, fname))
+                total += st.st_size
+
+        nfiles, nbytes = 0, 0
+        if total > limit:
+            files.sort()
+            target = limit * _trimFraction
+            for mtime, size, fname in files:
+                if total <= target: break
+                try:
+                    os.remove(fname)
+                except OSError:
+                    continue
+                total -= size
+                nfiles += 1
+                nbytes += size
+        _writeSize(path, total, now)
+        return nfiles, nbytes
+    finally:
+        lock.close()
+
+
+def _report(path, limit):
+    cls = DerivedFileCache
+    misses = cls.requests - cls.hits
+    if cls.requests or cls.pushes:
+        print("Derived-file cache %s: %d hits, %d misses (%.1f%% hit rate), %d files added" %
+              (path, cls.hits, misses, 100.*cls.hits/cls.requests if cls.requests else 0., cls.pushes))
+    if limit > 0 and cls.pushes and os.path.isdir(path):
+        res = trimCache(path, limit, cls.pushedBytes)
+        if res and res[0]:
+            print("Derived-file cache %s: removed %d least recently used files (%.1f MB)" %
+                  (path, res[0], res[1] / 1048576.))
+
+
+def enableDerivedCache(env, cacheDir, size):
+    """Use shared cache of derived files in directory cacheDir/$SIT_ARCH"""
+    path = os.path.join(os.path.abspath(cacheDir), env['SIT_ARCH'])
+    try:
+        limit = parseSize(size)
+    except ValueError:
+        fail("Invalid CACHE_SIZE value `%s', expected number with optional K, M, G or T suffix" % size)
+    try:
+        env.CacheDir(path, custom_class=DerivedFileCache)
+    except TypeError:
+        # older SCons without custom CacheDir classes, no filtering or statistics
+        env.CacheDir(path)
+        return
+    atexit.register(_report, path, limit)
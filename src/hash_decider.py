@@ -0,0 +1,153 @@
+#===============================================================================
+#
+# Content-hash decider with persistent hash cache
+#
+# $Id$
+#
+#===============================================================================
+
+"""
+SCons decider which compares content hashes of the dependencies instead of
+their timestamps, so that touching a file, checking out the same content
+or copying files does not trigger rebuilds. Hashes are kept in a cache
+file indexed by path and (inode, size, mtime) of the file, a file is only
+read again when one of those changes.
+
+The hash is the same as the content signature (csig) which SCons stores in
+.sconsign, so switching between this decider and SCons 'content' decider
+does not rebuild anything. Files modified in the last few seconds are not
+put into the cache because their mtime may not change on the next write.
+
+Enabled with DECIDER=content-cache.
+"""
+from __future__ import print_function
+
+import os
+import time
+import atexit
+
+from six.moves import cPickle as pickle
+
+import SCons.Util
+import SCons.Node.FS
+
+if hasattr(SCons.Util, 'hash_file_signature'):
+    _fileSignature = SCons.Util.hash_file_signature
+else:
+    _fileSignature = SCons.Util.MD5filesignature
+
+# chunk size for reading files, older SCons versions call it md5_chunksize
+# and some of them give it in kilobytes
+_chunkSize = getattr(SCons.Node.FS.File, 'hash_chunksize', None) or getattr(SCons.Node.FS.File, 'md5_chunksize', 64)
+if _chunkSize < 1024: _chunkSize *= 1024
+
+# files modified less than this many seconds ago are not cached
+_racyInterval = 2.
+
+_VERSION = 1
+
+
+class HashCache(object):
+    """Content hashes of files indexed by path and (inode, size, mtime)"""
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.hashes = {}
+        self.modified = False
+        # paths which were read and hashed, and those found in cache
+        self.hashed = set()
+        self.cached = set()
+        try:
+            f = open(fileName, 'rb')
+            try:
+                version, hashes = pickle.load(f)
+            finally:
+                f.close()
+            if version == _VERSION: self.hashes = hashes
+        except Exception:
+            # missing or broken cache is re-created
+            pass
+
+    def hash(self, path):
+        """Returns content hash of the file, raises OSError if file does not exist"""
+        st = os.stat(path)
+        key = (st.st_ino, st.st_size, st.st_mtime)
+        rec = self.hashes.get(path)
+        if rec is not None and rec[0] == key:
+            self.cached.add(path)
+            return rec[1]
+
+        self.hashed.add(path)
+        csig = _fileSignature(path, chunksize=_chunkSize)
+        if time.time() - st.st_mtime > _racyInterval:
+            self.hashes[path] = (key, csig)
+            self.modified = True
+        elif path in self.hashes:
+            del self.hashes[path]
+            self.modified = True
+        return csig
+
+    def save(self):
+        if not self.modified: return
+        d = os.path.dirname(self.fileName)
+        if d and not os.path.isdir(d): os.makedirs(d)
+        # write and rename so that concurrent builds never see partial file
+        tmp = "%s.%d" % (self.fileName, os.getpid())
+        f = open(tmp, 'wb')
+        pickle.dump((_VERSION, self.hashes), f, 2)
+        f.close()
+        os.rename(tmp, self.fileName)
+        self.modified = False
+
+
+class ContentCacheDecider(object):
+    """
+    Decider function, dependency has changed if its content hash differs
+    from the one stored for the target. Also counts the cases where the
+    timestamp-newer decider would have rebuilt the target.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.newerSame = 0
+        self.targetsNewer = set()
+        self.targetsChanged = set()
+
+    def __call__(self, dependency, target, prev_ni, repo_node=None):
+
+        if not isinstance(dependency, SCons.Node.FS.File):
+            return dependency.changed_content(target, prev_ni)
+
+        try:
+            csig = self.cache.hash(dependency.rfile().get_abspath())
+        except (OSError, IOError):
+            return dependency.changed_content(target, prev_ni)
+
+        # SCons uses this signature instead of reading the file again
+        dependency.get_ninfo().csig = csig
+
+        changed = getattr(prev_ni, 'csig', None) != csig
+        if changed:
+            self.targetsChanged.add(target)
+        elif dependency.changed_timestamp_newer(target, prev_ni):
+            self.newerSame += 1
+            self.targetsNewer.add(target)
+        return changed
+
+    def report(self):
+        avoided = len(self.targetsNewer - self.targetsChanged)
+        print("Content-hash decider: %d files hashed, %d hashes from cache; "
+              "%d dependencies newer than target but unchanged, %d rebuilds avoided" %
+              (len(self.cache.hashed), len(self.cache.cached - self.cache.hashed), self.newerSame, avoided))
+
+
+def setDecider(env, decider, cacheName):
+    """Set decider for the environment, decider is SCons decider name or 'content-cache'"""
+    if decider != 'content-cache':
+        env.Decider(decider)
+        return
+    cache = HashCache(cacheName)
+    func = ContentCacheDecider(cache)
+    env.Decider(func)
+    atexit.register(func.report)
+    atexit.register(cache.save)
@@ -0,0 +1,174 @@
+#===============================================================================
+#
+# Timing and memory profile of the phases of SConstruct.main
+#
+# $Id$
+#
+#===============================================================================
+
+"""
+Records wall time, CPU time and peak memory of the process for the top-level phases of
+the build (reading SConscript files, dependency analysis, DAG walk, etc.)
+and writes them as JSON and as Chrome trace-event file which can be
+loaded into chrome://tracing or Perfetto.
+
+Profiling is disabled by default, calls to phase() are then cheap no-ops.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+from contextlib import contextmanager
+
+if hasattr(time, 'process_time'):
+    _cpu = time.process_time
+else:
+    _cpu = time.clock
+
+_enabled = False
+_phases = []
+_stack = []
+_t0 = time.time()
+_pid = os.getpid()
+
+
+def processMaxRss():
+    """Peak resident memory of this process since it started in kB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # MacOS reports bytes, Linux kB
+    if sys.platform == 'darwin': rss //= 1024
+    return rss
+
+
+class _Phase(object):
+
+    def __init__(self, name, cat, wall, cpu, rss, args):
+        self.name = name
+        self.cat = cat
+        self.depth = len(_stack)
+        self.start = wall
+        self.cpu = cpu
+        self.rss = rss
+        self.args = dict(args)
+        self.wall = None
+
+    def end(self):
+        self.wall = time.time() - self.start
+        self.cpu = _cpu() - self.cpu
+        self.maxrss = processMaxRss()
+
+    def record(self):
+        # memory is the peak of the whole process at the end of the phase,
+        # growth is how much the phase raised that peak
+        rec = dict(name=self.name, cat=self.cat, depth=self.depth,
+                   start=self.start - _t0, wall=self.wall, cpu=self.cpu,
+                   process_maxrss_kb=self.maxrss, process_maxrss_growth_kb=self.maxrss - self.rss)
+        rec.update(self.args)
+        return rec
+
+    def event(self):
+        args = dict(cpu=round(self.cpu, 6), process_maxrss_kb=self.maxrss)
+        args.update(self.args)
+        return dict(name=self.name, cat=self.cat, ph='X', pid=_pid, tid=0,
+                    ts=int((self.start - _t0)*1e6), dur=int(self.wall*1e6), args=args)
+
+
+def enableProfile(startTime=None):
+    """Enable profiling, optional start time (from time.time()) is the start of the whole build"""
+    global _enabled, _t0
+    _enabled = True
+    if startTime is not None: _t0 = startTime
+
+
+def profileEnabled():
+    return _enabled
+
+
+def beginPhase(name, cat='phase', startTime=None, startCpu=None, startRss=None, **args):
+    """
+    Start new phase, phases can be nested, each has to be closed with endPhase().
+    Phase which started before profiling was enabled is given its start time,
+    CPU time and processMaxRss() at the start.
+    """
+    if not _enabled: return
+    if startTime is None: startTime = time.time()
+    if startCpu is None: startCpu = _cpu()
+    if startRss is None: startRss = processMaxRss()
+    p = _Phase(name, cat, startTime, startCpu, startRss, args)
+    _stack.append(p)
+    _phases.append(p)
+
+
+def endPhase(**args):
+    """Close the innermost phase, keyword arguments are added to its record"""
+    if not _enabled or not _stack: return
+    p = _stack.pop()
+    p.args.update(args)
+    p.end()
+
+
+@contextmanager
+def phase(name, cat='phase', **args):
+    """Context manager for beginPhase()/endPhase()"""
+    beginPhase(name, cat, **args)
+    try:
+        yield
+    finally:
+        endPhase()
+
+
+def countFsNodes(roots):
+    """Number of file system nodes (files and directories) below the given SCons root directories"""
+    n = 0
+    stack = list(roots)
+    while stack:
+        d = stack.pop()
+        for name, e in d.entries.items():
+            if name in ('.', '..'): continue
+            n += 1
+            if getattr(e, 'entries', None) is not None: stack.append(e)
+    return n
+
+
+def writeProfile(dirName, prefix="profile"):
+    """Close all open phases and write <prefix>.json and <prefix>.trace.json into the directory"""
+
+    if not _enabled: return
+    while _stack: endPhase()
+
+    if not os.path.isdir(dirName): os.makedirs(dirName)
+    report = dict(start=_t0, wall=time.time() - _t0, cpu=_cpu(), maxrss_kb=processMaxRss(),
+                  argv=sys.argv, phases=[p.record() for p in _phases])
+    fname = os.path.join(dirName, prefix + ".json")
+    f = open(fname, 'w')
+    json.dump(report, f, indent=1, sort_keys=True)
+    f.close()
+
+    tname = os.path.join(dirName, prefix + ".trace.json")
+    f = open(tname, 'w')
+    json.dump(dict(traceEvents=[p.event() for p in _phases], displayTimeUnit='ms'), f)
+    f.close()
+
+    print("Profile written to %s and %s" % (fname, tname))
+    for p in _phases:
+        if p.cat != 'phase': continue
+        print("  %-30s wall %8.2fs  cpu %8.2fs  process peak RSS %8.1f MB (+%.1f)" %
+              ('  ' * p.depth + p.name, p.wall, p.cpu, p.maxrss / 1024., (p.maxrss - p.rss) / 1024.))
+
+
+def profileAtExit(dirName, name, countNodes=None, prefix="profile"):
+    """
+    Open phase which lasts until the interpreter exits (used for the DAG walk),
+    then write the profile. countNodes is called at exit to add node count.
+    """
+    if not _enabled: return
+    beginPhase(name)
+    def _finish():
+        if countNodes is not None:
+            endPhase(nodes=countNodes())
+        writeProfile(dirName, prefix)
+    atexit.register(_finish)
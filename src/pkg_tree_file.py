@@ -0,0 +1,250 @@
+#===============================================================================
+#
+# Binary file format for the package dependency tree
+#
+# $Id$
+#
+#===============================================================================
+
+"""
+Compact, versioned file format for the package dependency tree (the
+structure described in dependencies.py, stored in .pkg_tree.pkl files).
+
+This module does not depend on SCons and can be used by other tools.
+File layout, all integers are little-endian unsigned 32-bit:
+
+  header:    magic "SITPKGT\\0", version, number of strings, number of
+             packages, offset of string table, offset of package index,
+             offset and size of metadata block
+  strings:   (nstrings+1) offsets into the blob, blob of UTF-8 names;
+             package and library names and directories are interned here
+  index:     npkgs pairs (name string index, record offset) sorted by name
+  records:   for each of DEPS, LIBS, LIBDIRS a count followed by that many
+             string indices; count 0xFFFFFFFF means the key is absent
+  metadata:  opaque bytes, used by callers to store e.g. cache keys
+
+Files are memory-mapped when read, package records are only decoded when
+they are accessed. Files which do not start with the magic are read with
+pickle, which was the original format.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import mmap
+import struct
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+MAGIC = b'SITPKGT\0'
+VERSION = 1
+FIELDS = ('DEPS', 'LIBS', 'LIBDIRS')
+
+_HEADER = struct.Struct('<8s7I')
+_ABSENT = 0xFFFFFFFF
+
+
+class _LazyRecord(Mapping):
+    """Package record which is decoded on first access"""
+
+    __slots__ = ('_file', '_offset', '_data')
+
+    def __init__(self, file, offset):
+        self._file = file
+        self._offset = offset
+        self._data = None
+
+    def _decode(self):
+        if self._data is None:
+            self._data = self._file._decodeRecord(self._offset)
+        return self._data
+
+    def __getitem__(self, key):
+        return self._decode()[key]
+
+    def __iter__(self):
+        return iter(self._decode())
+
+    def __len__(self):
+        return len(self._decode())
+
+    def __repr__(self):
+        return repr(self._decode())
+
+
+class PkgTreeFile(Mapping):
+    """Read-only mapping of package name to its record, backed by the file"""
+
+    def __init__(self, fileName):
+
+        self.fileName = fileName
+        f = open(fileName, 'rb')
+        try:
+            try:
+                self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                # e.g. empty file, let the header check below fail
+                self._buf = f.read()
+        finally:
+            f.close()
+
+        if len(self._buf) < _HEADER.size:
+            raise ValueError("%s: file is too short" % fileName)
+        magic, version, nstrings, npkgs, stroff, pkgoff, metaoff, metalen = _HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC:
+            raise ValueError("%s: not a package tree file" % fileName)
+        if version != VERSION:
+            raise ValueError("%s: unsupported package tree file version %d" % (fileName, version))
+
+        self.version = version
+        self._stroffsets = struct.unpack_from('<%dI' % (nstrings+1), self._buf, stroff)
+        self._blob = stroff + 4*(nstrings+1)
+        self._strings = {}
+        self.metadata = self._buf[metaoff:metaoff+metalen]
+
+        index = struct.unpack_from('<%dI' % (2*npkgs), self._buf, pkgoff)
+        self._index = {}
+        for i in range(npkgs):
+            self._index[self._string(index[2*i])] = index[2*i+1]
+
+    def _string(self, i):
+        try:
+            return self._strings[i]
+        except KeyError:
+            pass
+        s = self._buf[self._blob+self._stroffsets[i]:self._blob+self._stroffsets[i+1]]
+        if not isinstance(s, str): s = s.decode('utf-8')
+        self._strings[i] = s
+        return s
+
+    def _decodeRecord(self, offset):
+        rec = {}
+        for field in FIELDS:
+            count, = struct.unpack_from('<I', self._buf, offset)
+            offset += 4
+            if count == _ABSENT: continue
+            idx = struct.unpack_from('<%dI' % count, self._buf, offset)
+            offset += 4*count
+            rec[field] = [self._string(i) for i in idx]
+        return rec
+
+    def __getitem__(self, pkg):
+        return _LazyRecord(self, self._index[pkg])
+
+    def __contains__(self, pkg):
+        return pkg in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+
+def readPkgTree(fileName):
+    """
+    Returns the mapping of package names to records from the file. Compact
+    files give lazily decoded PkgTreeFile, anything else is read by pickle.
+    """
+    f = open(fileName, 'rb')
+    magic = f.read(len(MAGIC))
+    if magic == MAGIC:
+        f.close()
+        return PkgTreeFile(fileName)
+    f.seek(0)
+    try:
+        return pickle.load(f)
+    finally:
+        f.close()
+
+
+def writePkgTree(fileName, tree, metadata=b''):
+    """
+    Store the package tree in compact format. Raises ValueError if the tree
+    has something that the format cannot represent. File is replaced
+    atomically so that readers which have it mapped are not disturbed.
+    """
+
+    strings = []
+    stridx = {}
+    def intern(s):
+        try:
+            return stridx[s]
+        except KeyError:
+            if not isinstance(s, (type(u''), type(b''))):
+                raise ValueError("non-string value in package tree: %r" % (s,))
+            stridx[s] = len(strings)
+            strings.append(s)
+            return stridx[s]
+
+    # package records
+    pkgs = sorted(tree)
+    records = []
+    for pkg in pkgs:
+        info = tree[pkg]
+        extra = set(info) - set(FIELDS)
+        if extra:
+            raise ValueError("unsupported keys for package %s: %s" % (pkg, ', '.join(sorted(extra))))
+        intern(pkg)
+        rec = []
+        for field in FIELDS:
+            if field in info:
+                values = [intern(v) for v in info[field]]
+                rec.append(struct.pack('<%dI' % (len(values)+1), len(values), *values))
+            else:
+                rec.append(struct.pack('<I', _ABSENT))
+        records.append(b''.join(rec))
+
+    # string table
+    blobs = []
+    offsets = [0]
+    for s in strings:
+        if not isinstance(s, bytes): s = s.encode('utf-8')
+        blobs.append(s)
+        offsets.append(offsets[-1] + len(s))
+    strtable = struct.pack('<%dI' % len(offsets), *offsets) + b''.join(blobs)
+
+    # layout
+    stroff = _HEADER.size
+    pkgoff = stroff + len(strtable)
+    pkgoff += (-pkgoff) % 4
+    recoff = pkgoff + 8*len(pkgs)
+    index = []
+    for pkg, rec in zip(pkgs, records):
+        index += [stridx[pkg], recoff]
+        recoff += len(rec)
+    metaoff = recoff
+
+    header = _HEADER.pack(MAGIC, VERSION, len(strings), len(pkgs), stroff, pkgoff, metaoff, len(metadata))
+    data = [header, strtable, b'\0' * (pkgoff - stroff - len(strtable)),
+            struct.pack('<%dI' % len(index), *index)] + records + [metadata]
+
+    tmp = "%s.tmp%d" % (fileName, os.getpid())
+    f = open(tmp, 'wb')
+    try:
+        for d in data: f.write(d)
+    finally:
+        f.close()
+    os.rename(tmp, fileName)
+
+
+#
+# Dump the content of the file, can be used without SCons
+#
+if __name__ == '__main__':
+
+    import json
+
+    if len(sys.argv) < 2:
+        print("Usage: %s file [package ...]" % sys.argv[0], file=sys.stderr)
+        sys.exit(2)
+
+    tree = readPkgTree(sys.argv[1])
+    pkgs = sys.argv[2:] or sorted(tree)
+    print(json.dumps(dict((pkg, dict(tree[pkg])) for pkg in pkgs if pkg in tree), indent=2, sort_keys=True))
@@ -9,6 +9,7 @@ from __future__ import print_function
 
 import os
 import sys
+import atexit
 from pprint import *
 from os.path import join as pjoin
 
@@ -16,6 +17,9 @@ from SCons.Defaults import *
 from SCons.Script import *
 
 from SConsTools.trace import *
+from SConsTools.action_stats import enableActionStats
+from SConsTools.compile_workers import enableCompileWorkers
+from SConsTools.derived_cache import enableDerivedCache
 
 def get_conda_env_path(fail_if_not_conda=True):
     '''conda used to use CONDA_ENV_PATH, and now it is CONDA_PREFIX,
@@ -35,6 +39,9 @@ def get_conda_env_path(fail_if_not_conda=True):
     else:
         return None
 
+def _dumpTraceOnFailure():
+    if GetBuildFailures(): dumpTraceRing()
+
 def _getNumCpus():
     # determin a number of CPUs in a system
     try:
@@ -67,7 +74,26 @@ def buildEnv () :
         ('SIT_REPOS', "Use to change the SIT_REPOS value during build", os.environ.get('SIT_REPOS', "")),
         PathVariable('PKG_DEPS_FILE', "Name of the package dependency file", '.pkg_tree.pkl', PathVariable.PathAccept),
         PathVariable('PKG_LIST_FILE', "Name of the package list file", '/dev/stdout', PathVariable.PathAccept),
-        ('TRACE', "Set to positive value to trace processing", 0)
+        ('TRACE', "Set to positive value to trace processing, per-category levels can follow, e.g. 2,adjustPkgDeps=4", 0),
+        PathVariable('TRACE_FILE', "File to write trace messages as JSON lines", '', PathVariable.PathAccept),
+        ('TRACE_RING', "Number of recent trace messages (up to level 4) kept in memory and printed on failure", 0),
+        BoolVariable('PROFILE', "Set to 1 to write timing and memory profile of build phases to build/$SIT_ARCH", False),
+        BoolVariable('ACTION_STATS', "Set to 1 to record time and resources of all actions in build/$SIT_ARCH/action_stats.jsonl", False),
+        BoolVariable('SCAN_STATS', "Set to 1 to print include scanner statistics at the end of the build", False),
+        ('COMPILER_CACHE', "Compiler cache command to wrap compilers with (e.g. ccache), 'auto' to use ccache if available", ""),
+        PathVariable('COMPILER_CACHE_DIR', "Directory for compiler cache, may be shared between users", '', PathVariable.PathAccept),
+        EnumVariable('LINKER', "Linker to use, 'auto' selects lld or gold if available, debug builds also get split DWARF and gdb index", "", allowed_values=('', 'auto', 'gold', 'lld')),
+        EnumVariable('TEST_LINK', "Link mode for test executables when LINKER is set, both skip gdb index: incremental (gold only) or thin (also -O0 with lld)", "", allowed_values=('', 'incremental', 'thin')),
+        ('UNITY', "Default maximum number of C++ library sources compiled together in one unity file, 0 to disable", 0),
+        ('COMPILE_WORKERS', "Comma-separated list of host:port of compile workers (see compile_workers.py) to send compilations to", ""),
+        PathVariable('COMPILE_WORKERS_SECRET', "File with secret shared with compile workers, def: ~/.compile_worker_secret", '', PathVariable.PathAccept),
+        EnumVariable('DECIDER', "How to decide if dependency changed, content-cache compares content hashes kept in build/$SIT_ARCH/.hash_cache",
+                     "timestamp-newer", allowed_values=('timestamp-newer', 'timestamp-match', 'content', 'content-timestamp', 'content-cache')),
+        PathVariable('CACHE_DIR', "Directory of derived-file cache shared between releases, files go to CACHE_DIR/$SIT_ARCH", '', PathVariable.PathAccept),
+        ('CACHE_SIZE', "Size limit of derived-file cache (e.g. 500M, 20G), least recently used files are removed, 0 for no limit", "0"),
+        ('SCAN_THREADS', "Number of threads reading source files before dependency scan, 0 to disable", 0),
+        ('PKGS', "Comma-separated list of changed packages for package-impact target", ""),
+        EnumVariable('IMPACT_FORMAT', "Output format for package-impact target", "text", allowed_values=('text', 'json')),
     )
 
     not_conda = os.environ.get('SIT_USE_CONDA', None) is None
@@ -98,7 +124,11 @@ def buildEnv () :
         env['EXTPKG_IN_MULTIPLE_LOC_OK'] = os.environ.get('SIT_EXTPKG_IN_MULTIPLE_LOC_OK', False)
 
     # set trace level based on the command line value
-    setTraceLevel(int(env['TRACE']))
+    setTraceLevel(env['TRACE'])
+    if env['TRACE_FILE']: setTraceFile(env['TRACE_FILE'])
+    if int(env['TRACE_RING']):
+        setTraceRing(int(env['TRACE_RING']))
+        atexit.register(_dumpTraceOnFailure)
 
     # get repository list from it
     sit_repos = [ r for r in env['SIT_REPOS'].split(':') if r ]
@@ -182,7 +212,7 @@ def buildEnv () :
     env.Replace(TOOLPATH=toolpath)
 
     # extend environment with tools
-    tools = ['psdm_cplusplus', 'psdm_python', 'pyext', 'cython', 'symlink',
+    tools = ['psdm_cplusplus', 'psdm_python', 'pyext', 'cython', 'pch', 'unity', 'symlink',
              'pycompile', 'pylint', 'unittest', 'script_install', 'pkg_list',
              'special_scanners']
     if env['CONDA']:
@@ -190,6 +220,14 @@ def buildEnv () :
     else:
         tools.append('release_install')
 
+    # send compilations to workers, before action stats so that they are timed too
+    if env['COMPILE_WORKERS']:
+        enableCompileWorkers(env, env['COMPILE_WORKERS'], _getNumCpus(), env['COMPILE_WORKERS_SECRET'])
+
+    # record time and resources of every action
+    if env['ACTION_STATS']:
+        enableActionStats(env, pjoin("build", sit_arch, "action_stats.jsonl"))
+
     trace ("toolpath = " + pformat(toolpath), "buildEnv", 3)
     for tool in tools:
         tool = env.Tool(tool, toolpath=toolpath)
@@ -205,6 +243,10 @@ def buildEnv () :
     # use alternative location for sconsign file
     env.SConsignFile(pjoin("build", sit_arch, ".sconsign"))
 
+    # shared cache of derived files
+    if env['CACHE_DIR']:
+        enableDerivedCache(env, env['CACHE_DIR'], env['CACHE_SIZE'])
+
     if env['CONDA']:
         conda_lib = pjoin(env['CONDA_ENV_PATH'], 'lib')
         rpath_string = env.Literal("'$$ORIGIN/../lib:%s'" % conda_lib)
@@ -223,7 +265,7 @@ def buildEnv () :
     # generate help
     Help(vars.GenerateHelpText(env))
 
-    trace ("Build env = " + pformat(env.Dictionary()), "buildEnv", 7)
+    if traceEnabled("buildEnv", 7): trace ("Build env = " + pformat(env.Dictionary()), "buildEnv", 7)
 
     #for r in sit_repos :
     #    trace ( "Add repository "+r, "<top>", 2 )
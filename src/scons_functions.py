@@ -27,6 +27,7 @@ def warning(msg):
     print("WARNING:", msg, file=sys.stderr)
 
 def fail ( msg, code = 2 ):
+    dumpTraceRing()
     print(msg, file=sys.stderr)
     print("Exiting with code %d" % code, file=sys.stderr)
     Exit(code)
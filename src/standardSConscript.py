@@ -7,6 +7,7 @@
 #===============================================================================
 
 import os
+import re
 import sys
 import six
 from pprint import *
@@ -21,8 +22,20 @@ from SConsTools.scons_functions import *
 
 
 _cplusplus_ext = [ 'cc', 'cpp', 'cxx', 'C', 'c' ]
+# C++ sources, only these are put into unity files and compiled with
+# precompiled header (C++ header cannot be used for C sources)
+_unity_ext = [ '.cc', '.cpp', '.cxx', '.C' ]
 _cython_ext = [ 'pyx' ]
 
+# directories whose sources are compiled with precompiled header
+_pch_dirs = [ 'src', 'app', 'test', 'pyext' ]
+
+# include lines considered for PCH="auto"
+_include_re = re.compile(r'^[ \t]*#[ \t]*include[ \t]*(<|")([^>"]+)[>"]', re.M)
+
+# precompiled headers made so far, key is (package, shared)
+_pch_cache = {}
+
 # normalize source file path
 def _normbinsrc ( dir, f ):
     if not os.path.split(f)[0] :
@@ -61,6 +74,11 @@ def standardSConscript( **kw ) :
         UTESTSEXCL - names of unit tests to exclude. Applied after UTESTS filter applied.
         PYEXTMOD - name of the Python extension module, package name used by default
         CCFLAGS - additional flags passed to C/C++ compilers
+        PCH - header to precompile, spelled as in #include, or "auto" to use the header
+              included most often by the package sources (gcc only)
+        UNITY - compile up to this many C++ library sources together as one unity file,
+                default is taken from UNITY option, 0 or 1 to disable
+        UNITY_EXCLUDE - names of library sources (without directory) to always compile separately
         NEED_QT - set to True to enable Qt support
         PHPDIR - either string or dictionary, will link directory to arch/../php/ area
         DOCGEN   - if this is is a string or list of strings then it should be name(s) of document
@@ -123,7 +141,7 @@ def standardMoc( env, **kw ) :
     headers = [str(h) for h in headers]
 
     headers = [h for h in headers if 'Q_OBJECT' in open(h).read()]
-    trace ( "moc headers = "+str(list(map(str,headers))), "SConscript", 2 )
+    trace ( "moc headers = %s", "SConscript", 2, lazyList(headers) )
 
     for h in headers:
         base = os.path.splitext(os.path.basename(h))[0]
@@ -139,7 +157,7 @@ def standardLib( env, **kw ) :
     libsrcs.sort()
     if libsrcs :
 
-        trace ( "libsrcs = "+str(list(map(str,libsrcs))), "SConscript", 2 )
+        trace ( "libsrcs = %s", "SConscript", 2, lazyList(libsrcs) )
 
         pkg = _getpkg( kw )
 
@@ -155,6 +173,8 @@ def standardLib( env, **kw ) :
             binkw['CCFLAGS'] = env['CCFLAGS'] + ' ' + kw['CCFLAGS']
         if 'LINKFLAGS' in kw:
             binkw['LINKFLAGS'] = env['LINKFLAGS'] + ' ' + kw['LINKFLAGS']
+        libsrcs = _unitySources ( env, libsrcs, **kw )
+        libsrcs = _pchObjects ( env, env.SharedObject, True, libsrcs, binkw, **kw )
         lib = env.SharedLibrary ( pkg, source=libsrcs, **binkw )
         ilib = env.Install ( libdir, source=lib )
         DefaultEnvironment()['ALL_TARGETS']['LIBS'].extend ( ilib )
@@ -178,7 +198,7 @@ def standardPyLib( env, **kw ) :
 
         pydir = env['PYDIR']
 
-        trace ( "pysrcs = "+str(list(map(str,pysrcs))), "SConscript", 2 )
+        trace ( "pysrcs = %s", "SConscript", 2, lazyList(pysrcs) )
 
         # python files area installed into python/Package
         doinit = True
@@ -214,15 +234,15 @@ def standardPyExt( env, **kw ) :
 
     # check for Cython files first
     cysrcs = Flatten([MyGlob("pyext/*."+ext, source=True, strings=True, recursive=True) for ext in _cython_ext])
-    trace ( "cysrcs = "+str(list(map(str, cysrcs))), "SConscript", 2 )
+    trace ( "cysrcs = %s", "SConscript", 2, lazyList(cysrcs) )
     extsrcs = [env.Cython(src) for src in cysrcs]
-    trace ( "pyextsrc = "+str(list(map(str, extsrcs))), "SConscript", 2 )
+    trace ( "pyextsrc = %s", "SConscript", 2, lazyList(extsrcs) )
 
     # this glob will find *.c files produced by Cython so I don't add above files
     extsrcs = Flatten([MyGlob("pyext/*."+ext, source=True, strings=True, recursive=True) for ext in _cplusplus_ext])
     if extsrcs :
 
-        trace ( "pyextsrc = "+str(list(map(str, extsrcs))), "SConscript", 2 )
+        trace ( "pyextsrc = %s", "SConscript", 2, lazyList(extsrcs) )
 
         pydir = env['PYDIR']
 
@@ -234,11 +254,20 @@ def standardPyExt( env, **kw ) :
         if 'LINKFLAGS' in kw:
             binkw['LINKFLAGS'] = env['LINKFLAGS'] + ' ' + kw['LINKFLAGS']
 
-        objects = [env.PythonObject(src, **binkw) for src in extsrcs]
+        pch = _standardPch ( env, True, **kw )
+        objects = []
+        for src in extsrcs :
+            if pch and _isCxx(src) :
+                gch, flags = pch
+                obj = env.PythonObject(src, **dict(binkw, CCFLAGS=binkw.get('CCFLAGS', env['CCFLAGS']) + ' ' + flags))
+                env.Depends ( obj, gch )
+            else :
+                obj = env.PythonObject(src, **binkw)
+            objects.append ( obj )
         # if package builds standard library then add it to the link
         libs = DefaultEnvironment()['PKG_TREE_LIB'].get(pkg, [])
         if libs: libs = [pkg]
-        trace ( "pyext libs = "+str(list(map(str, libs))), "SConscript", 2 )
+        trace ( "pyext libs = %s", "SConscript", 2, lazyList(libs) )
         extmod = env.PythonExtension ( extmodname, source=objects, LIBS=libs)
         iextmod = env.Install ( pydir, source=extmod )
         DefaultEnvironment()['ALL_TARGETS']['LIBS'].extend ( iextmod )
@@ -248,6 +277,124 @@ def standardPyExt( env, **kw ) :
 
         return extmodname
 
+#
+# Make precompiled header for a package, shared=True for the variant used
+# with shared objects. Returns None if package does not use PCH, otherwise
+# (gch node, flags to compile sources with).
+#
+def _standardPch( env, shared, **kw ) :
+
+    header = kw.get('PCH')
+    if not header : return None
+    if not env['SIT_ARCH_COMPILER'].startswith('gcc') :
+        trace ( "PCH is only supported for gcc", "SConscript", 1 )
+        return None
+
+    pkg = _getpkg( kw )
+    try:
+        return _pch_cache[(pkg, shared)]
+    except KeyError:
+        pass
+
+    if header == 'auto' : header = _autoPch()
+    if not header :
+        trace ( "no header to precompile for `%s'", "SConscript", 2, pkg )
+        _pch_cache[(pkg, shared)] = None
+        return None
+    trace ( "PCH header for `%s' = %s", "SConscript", 2, pkg, header )
+
+    variant = "shared" if shared else "static"
+    wrapper = env.PchHeader ( pjoin("pch", variant, pkg+"_pch.h"), env.Value(header) )
+    pchkw = {}
+    if 'CCFLAGS' in kw:
+        pchkw['CCFLAGS'] = env['CCFLAGS'] + ' ' + kw['CCFLAGS']
+    if shared :
+        gch = env.SharedPch ( str(wrapper[0])+".gch", wrapper, **pchkw )
+    else :
+        gch = env.Pch ( str(wrapper[0])+".gch", wrapper, **pchkw )
+    flags = '-include ' + wrapper[0].path + ' ' + env['PCHFLAGS']
+
+    res = _pch_cache[(pkg, shared)] = (gch, flags)
+    return res
+
+#
+# Find header included most often (and at least twice) by the package C++
+# sources, only headers found through include path are considered
+#
+def _autoPch() :
+
+    counts = {}
+    for dir in _pch_dirs :
+        for ext in _unity_ext :
+            for src in Glob(dir+"/*"+ext, source=True) :
+                try:
+                    text = open(src.srcnode().abspath).read()
+                except EnvironmentError:
+                    continue
+                for delim, name in set(_include_re.findall(text)) :
+                    if delim == '<' or '/' in name :
+                        counts[name] = counts.get(name, 0) + 1
+    if not counts : return None
+    name, count = max(sorted(counts.items()), key=lambda x: x[1])
+    if count < 2 : return None
+    return name
+
+#
+# True for C++ source file name or node
+#
+def _isCxx( src ) :
+    return os.path.splitext(str(src))[1] in _unity_ext
+
+#
+# Returns sources with C++ sources replaced by objects compiled with
+# precompiled header, other sources are returned as they are
+#
+def _pchObjects( env, builder, shared, srcs, binkw, **kw ) :
+
+    pch = _standardPch ( env, shared, **kw )
+    if not pch : return srcs
+    cxx = [ s for s in srcs if _isCxx(s) ]
+    if not cxx : return srcs
+
+    gch, flags = pch
+    objects = builder ( cxx, CCFLAGS=binkw.get('CCFLAGS', env['CCFLAGS']) + ' ' + flags )
+    env.Depends ( objects, gch )
+    objects = iter(objects)
+    return [ next(objects) if _isCxx(s) else s for s in srcs ]
+
+#
+# Group library sources into unity files of at most UNITY sources, returns
+# new list of sources
+#
+def _unitySources( env, srcs, **kw ) :
+
+    nmax = int(kw.get('UNITY', env['UNITY']))
+    if nmax < 2 : return srcs
+
+    exclude = _getkwlist ( kw, 'UNITY_EXCLUDE' )
+    unity = [ s for s in srcs if os.path.splitext(s)[1] in _unity_ext and os.path.basename(s) not in exclude ]
+    if len(unity) < 2 : return srcs
+    res = [ s for s in srcs if s not in unity ]
+
+    pkg = _getpkg( kw )
+    for i in range(0, len(unity), nmax) :
+        group = unity[i:i+nmax]
+        if len(group) == 1 :
+            res += group
+            continue
+        # included files are relative to the directory of unity file
+        target = File(pjoin("unity", "%s_unity%d.cpp" % (pkg, i//nmax)))
+        tdir = target.get_dir().abspath
+        includes = [ os.path.relpath(File(s).srcnode().abspath, tdir) for s in group ]
+        trace ( "unity file %s = %s", "SConscript", 2, target, lazyList(includes) )
+        unity = env.UnityFile ( target, env.Value('\n'.join(includes)) )
+        # SCons does not scan the unity file before it is made, dependency
+        # analysis scans these instead
+        unity[0].attributes.included_sources = [ File(s) for s in group ]
+        res += unity
+
+    return res
+
 #
 # Process content of PHPDIR argument, create directories in $ARCHDIR/php.
 # If PHPDIR is a dictionary then it will create symlinks
@@ -320,7 +467,7 @@ def standardTests( env, **kw ) :
         utests = [t for t in utests if os.path.basename(str(t)) not in utestsexcl]
 
     # make new unit test target
-    trace ( "utests = "+str(list(map(str,utests))), "SConscript", 2 )
+    trace ( "utests = %s", "SConscript", 2, lazyList(utests) )
     for u in utests :
         t = env.UnitTest ( str(u)+'.utest', u )
         DefaultEnvironment()['ALL_TARGETS']['TESTS'].extend( t )
@@ -351,7 +498,7 @@ def _standardBins( env, appdir, binenv, install, **kw ) :
     targets = []
     if bins :
 
-        trace ( "bins = "+str(list(map(str,bins))), "SConscript", 2 )
+        trace ( "bins = %s", "SConscript", 2, lazyList(bins) )
 
         bindir = env['BINDIR']
 
@@ -364,10 +511,17 @@ def _standardBins( env, appdir, binenv, install, **kw ) :
             binkw['CCFLAGS'] = env['CCFLAGS'] + ' ' + kw['CCFLAGS']
         if 'LINKFLAGS' in kw:
             binkw['LINKFLAGS'] = env['LINKFLAGS'] + ' ' + kw['LINKFLAGS']
+        testlink = appdir == 'test' and env.get('TESTLINKFLAGS') is not None
+        if testlink:
+            binkw['LINKFLAGS'] = binkw.get('LINKFLAGS', env['LINKFLAGS']) + ' $TESTLINKFLAGS'
+            binkw['GDBINDEXFLAGS'] = ''
 
         for bin, srcs in bins.items() :
 
+            srcs = _pchObjects ( env, env.Object, False, srcs, binkw, **kw )
             b = env.Program( bin, source=srcs, **binkw )
+            # incremental linker needs the previous executable
+            if testlink and env.get('TEST_LINK') == 'incremental': env.Precious(b)
             setPkgBins ( kw['package'], b[0] )
             if install :
                 b = env.Install ( bindir, source=b )
@@ -390,7 +544,7 @@ def _standardScripts( env, appdir, binenv, installdir, **kw ) :
     else :
         scripts = [ _normbinsrc(appdir,s) for s in scripts ]
 
-    trace ( "scripts = "+str(list(map(str,scripts))), "SConscript", 2 )
+    trace ( "scripts = %s", "SConscript", 2, lazyList(scripts) )
 
     # Scripts are installed in 'installdir' directory
     targets = []
@@ -19,6 +19,7 @@ from SCons.Action import Action
 
 from SConsTools.trace import *
 from SConsTools.scons_functions import *
+from SConsTools.action_stats import timedAction
 
 #except ImportError:
 #    print "testing mode"
@@ -139,7 +140,7 @@ def create_builder(env):
     try:
         builder = env['BUILDERS']['CondaInstall']
     except KeyError:
-        builder = SCons.Builder.Builder(action=_makeCondaInstall())
+        builder = SCons.Builder.Builder(action=timedAction(env, _makeCondaInstall()))
         env['BUILDERS']['CondaInstall'] = builder
 
     return builder
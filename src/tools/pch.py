@@ -0,0 +1,89 @@
+"""SCons.Tool.pch
+
+Tool-specific initialization for precompiled header builders (gcc only).
+
+PchHeader builder makes a small header which includes the header to be
+precompiled, Pch and SharedPch builders compile it into .gch file with
+the same flags as used for static and shared objects respectively.
+Sources are compiled with `-include <wrapper>`, gcc then uses .gch file
+found next to the wrapper or falls back to the wrapper itself.
+
+"""
+
+import os
+
+import SCons
+from SCons.Action import Action
+
+from SConsTools.trace import *
+from SConsTools.scons_functions import *
+from SConsTools.action_stats import timedAction
+
+def _fmtList ( lst ):
+    return '[' + ','.join(map(str, lst)) + ']'
+
+class _pchHeader(object) :
+
+    def __call__ ( self, target, source, env ) :
+        """Target is a file, source is a Value with the name of the included header"""
+        if len(target) != 1 :
+            fail ( "unexpected number of targets for PchHeader: "+str(target) )
+        if len(source) != 1 :
+            fail ( "unexpected number of sources for PchHeader: "+str(source) )
+
+        target = str(target[0])
+        header = source[0].read()
+        trace ( "Executing PchHeader `%s' -> `%s'" % ( target, header ), "PchHeader", 3 )
+
+        # may need to make a directory for target
+        targetdir = os.path.dirname ( target )
+        if not os.path.isdir( targetdir ) : os.makedirs( targetdir )
+
+        f = open(target, 'w')
+        f.write('#include "%s"\n' % header)
+        f.close()
+
+    def strfunction ( self, target, source, env ):
+        try :
+            return "Creating precompiled header wrapper: \"" + str(target[0]) + "\""
+        except :
+            return 'PchHeader('+_fmtList(target)+', '+_fmtList(source)+')'
+
+def create_builders(env):
+    try:
+        builder = env['BUILDERS']['PchHeader']
+    except KeyError:
+        builder = SCons.Builder.Builder(action = timedAction(env, _pchHeader()))
+        env['BUILDERS']['PchHeader'] = builder
+    try:
+        builder = env['BUILDERS']['Pch']
+    except KeyError:
+        builder = SCons.Builder.Builder(action = Action("$PCHCOM", "$PCHCOMSTR"),
+                                        suffix = '.gch',
+                                        source_scanner = SCons.Tool.SourceFileScanner)
+        env['BUILDERS']['Pch'] = builder
+    try:
+        builder = env['BUILDERS']['SharedPch']
+    except KeyError:
+        builder = SCons.Builder.Builder(action = Action("$SHPCHCOM", "$SHPCHCOMSTR"),
+                                        suffix = '.gch',
+                                        source_scanner = SCons.Tool.SourceFileScanner)
+        env['BUILDERS']['SharedPch'] = builder
+
+def generate(env):
+    """Add Builders and construction variables for precompiled headers."""
+
+    env['PCHCOM'] = '$CXX -o $TARGET -x c++-header -c $CXXFLAGS $CCFLAGS $_CCCOMCOM $SOURCES'
+    env['SHPCHCOM'] = '$SHCXX -o $TARGET -x c++-header -c $SHCXXFLAGS $SHCCFLAGS $_CCCOMCOM $SOURCES'
+    env['PCHFLAGS'] = '-Winvalid-pch'
+    if env['ENV'].get('CCACHE_BASEDIR'):
+        # compiler cache needs these to handle precompiled headers
+        env['PCHFLAGS'] += ' -fpch-preprocess'
+        env['ENV'] = dict(env['ENV'], CCACHE_SLOPPINESS='pch_defines,time_macros')
+
+    create_builders(env)
+
+    trace ( "Initialized pch tool", "pch", 2 )
+
+def exists(env):
+    return True
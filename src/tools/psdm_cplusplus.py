@@ -1,7 +1,13 @@
 """
 Tool which selects correct C++ compiler version and options for PSDM releases.
 """
+from __future__ import print_function
+
 import os
+import re
+import sys
+import atexit
+import subprocess
 
 from SConsTools.trace import *
 from SConsTools.scons_functions import *
@@ -12,6 +18,199 @@ _gcc_opt = { 'opt' : '-O3',
 _ld_opt = { 'opt' : '',
             'dbg' : '-g' }
 
+# linkers which can be selected with LINKER option and their executables
+_linkers = { 'gold' : 'ld.gold',
+             'lld' : 'ld.lld' }
+
+# compiler variables which are wrapped with compiler cache, PYEXTCC and
+# PYEXTCXX are set later by pyext tool to $SHCC/$SHCXX and get wrapped
+# through those, variable references like "$CC" are not wrapped twice
+_cache_vars = ['CC', 'CXX', 'SHCC', 'SHCXX', 'PYEXTCC', 'PYEXTCXX']
+
+# names of counters in `ccache --print-stats` and `ccache -s` output
+_stats_keys = { 'hit' : ['direct_cache_hit', 'preprocessed_cache_hit'],
+                'miss' : ['cache_miss'] }
+_stats_re = { 'hit' : re.compile(r'^\s*cache hit \((?:direct|preprocessed)\)\s+(\d+)', re.M),
+              'miss' : re.compile(r'^\s*cache miss\s+(\d+)', re.M) }
+
+#
+# Returns dictionary with hit/miss counts of the compiler cache or None
+#
+def _cacheStats(cache, environ):
+    for opt in ['--print-stats', '-s']:
+        try:
+            p = subprocess.Popen([cache, opt], env=environ, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out = p.communicate()[0].decode('utf-8', 'replace')
+        except OSError:
+            return None
+        if p.returncode != 0: continue
+        stats = dict(hit=0, miss=0)
+        if opt == '--print-stats':
+            values = dict(line.split('\t', 1) for line in out.splitlines() if '\t' in line)
+            for key, names in _stats_keys.items():
+                stats[key] = sum(int(values.get(n, 0)) for n in names)
+        else:
+            for key, regex in _stats_re.items():
+                stats[key] = sum(int(m) for m in regex.findall(out))
+        return stats
+    return None
+
+#
+# Returns (major, minor) version of the compiler cache, (0, 0) if unknown
+#
+def _cacheVersion(cache, environ):
+    try:
+        p = subprocess.Popen([cache, '--version'], env=environ, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out = p.communicate()[0].decode('utf-8', 'replace')
+    except OSError:
+        return (0, 0)
+    m = re.search(r'version (\d+)\.(\d+)', out)
+    return (int(m.group(1)), int(m.group(2))) if m else (0, 0)
+
+#
+# Returns hit/miss counts from the stats log which ccache writes for every
+# compilation of this build, one counter name per line
+#
+def _statsLogStats(statslog):
+    stats = dict(hit=0, miss=0)
+    try:
+        f = open(statslog)
+        lines = f.read().split()
+        f.close()
+    except (IOError, OSError):
+        return stats
+    for key, names in _stats_keys.items():
+        stats[key] = sum(lines.count(n) for n in names)
+    return stats
+
+def _reportCacheStats(cache, environ, before, statslog):
+    if statslog:
+        stats = _statsLogStats(statslog)
+        scope = "this build"
+    else:
+        after = _cacheStats(cache, environ)
+        if after is None: return
+        stats = dict((key, after[key] - before[key]) for key in after)
+        # counters of a shared cache include other builds running meanwhile
+        scope = "cache-wide"
+    hit = stats['hit']
+    miss = stats['miss']
+    total = hit + miss
+    print("Compiler cache (%s): %d hits, %d misses (%.1f%% hit rate)" %
+          (scope, hit, miss, 100.*hit/total if total else 0.))
+
+#
+# Returns True if compiler driver accepts given link options
+#
+def _linkOptionsWork(env, options):
+    cmd = env.subst('$CXX').split() + options + ['-Wl,--version']
+    try:
+        p = subprocess.Popen(cmd, env=env['ENV'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        p.communicate()
+    except OSError:
+        return False
+    return p.returncode == 0
+
+#
+# Select linker, for debug builds put debug info into .dwo files and build
+# gdb index at link time, and set special link flags for test executables
+#
+def _setupLinker(env, opt):
+
+    linker = env['LINKER']
+    candidates = ['lld', 'gold'] if linker == 'auto' else [linker]
+    linker = None
+    for cand in candidates:
+        if env.WhereIs(_linkers[cand]) and _linkOptionsWork(env, ['-fuse-ld=' + cand]):
+            linker = cand
+            break
+    if linker is None:
+        print("WARNING: linker `%s' is not available, using default linker" % ' or '.join(candidates), file=sys.stderr)
+        return
+    env.Append(LINKFLAGS = ' -fuse-ld=' + linker)
+
+    if opt in ('dbg', 'prof'):
+        env.Append(CCFLAGS = ' -gsplit-dwarf')
+        env['GDBINDEXFLAGS'] = '-Wl,--gdb-index'
+        env.Append(LINKFLAGS = ' $GDBINDEXFLAGS')
+
+    # tests are relinked often but rarely debugged, skip gdb index for them;
+    # incremental mode updates the existing executable in place, so tests
+    # must not be deleted before linking (standardSConscript makes them
+    # Precious). In thin mode only lld gets -O0, its default is -O1 while
+    # gold and bfd do not optimize by default.
+    test_link = env['TEST_LINK']
+    if test_link == 'incremental':
+        if linker == 'gold':
+            # gold cannot do incremental link with plugins, relro and PIE
+            flags = ['-fno-use-linker-plugin', '-Wl,-z,norelro', '-Wl,--incremental']
+            if _linkOptionsWork(env, ['-no-pie']): flags.insert(1, '-no-pie')
+            env['TESTLINKFLAGS'] = ' '.join(flags)
+        else:
+            print("WARNING: incremental linking is only supported by gold linker", file=sys.stderr)
+    elif test_link == 'thin':
+        env['TESTLINKFLAGS'] = '-Wl,-O0' if linker == 'lld' else ''
+
+    trace ( "Linker: %s, test link flags: %s", "psdm_cplusplus", 2, linker, env.get('TESTLINKFLAGS') )
+
+#
+# Prefix compiler commands with compiler cache (ccache) and set it up so that
+# object files can be shared between different release directories and users
+#
+def _setupCompilerCache(env, comp):
+
+    cache = env['COMPILER_CACHE']
+    if cache in ('1', 'yes', 'on', 'true', 'auto'):
+        path = env.WhereIs('ccache')
+    else:
+        path = env.WhereIs(cache) or (os.access(cache, os.X_OK) and os.path.abspath(cache))
+    if not path:
+        if cache != 'auto':
+            print("WARNING: compiler cache `%s' not found, building without it" % cache, file=sys.stderr)
+        return
+
+    # linking is not cached, keep linker on the plain compiler
+    if env.get('LINK') == '$SMARTLINK':
+        env['LINK'] = env['CXX']
+
+    for var in _cache_vars:
+        cmd = env.get(var)
+        if not cmd or str(cmd).startswith('$'): continue
+        env[var] = path + ' ' + str(cmd)
+
+    # paths inside release directory are made relative in the hash, and
+    # current directory is not hashed, debug info gets relative paths instead
+    top = env.Dir('#').abspath
+    environ = dict(env['ENV'])
+    environ['CCACHE_BASEDIR'] = top
+    environ['CCACHE_NOHASHDIR'] = '1'
+    # cache may be shared between users
+    environ['CCACHE_UMASK'] = '002'
+    if env.get('COMPILER_CACHE_DIR'):
+        environ['CCACHE_DIR'] = os.path.abspath(env['COMPILER_CACHE_DIR'])
+    env['ENV'] = environ
+    if comp != 'gcc41':
+        env.Append(CCFLAGS = ' -fdebug-prefix-map=' + top + '=.')
+
+    # ccache 4.4 and newer log the counters of each compilation in a file,
+    # older versions only have global counters of the cache directory
+    statslog = None
+    before = None
+    if _cacheVersion(path, environ) >= (4, 4):
+        statslog = os.path.join(top, "build", env['SIT_ARCH'], "ccache_stats.log")
+        try:
+            if not os.path.isdir(os.path.dirname(statslog)): os.makedirs(os.path.dirname(statslog))
+            open(statslog, 'w').close()
+            environ['CCACHE_STATSLOG'] = statslog
+        except (IOError, OSError):
+            statslog = None
+    if statslog is None:
+        before = _cacheStats(path, environ)
+    if statslog or before is not None:
+        atexit.register(_reportCacheStats, path, environ, before, statslog)
+
+    trace ( "Compiler cache: %s", "psdm_cplusplus", 2, path )
+
 def generate(env):
     
     #os = env['SIT_ARCH_OS']
@@ -63,7 +262,13 @@ def generate(env):
             env.Append(CXXFLAGS = ' -Wno-invalid-offsetof -Wno-unused-local-typedefs')
         env.Append(LINKFLAGS = ' ' + _ld_opt.get(opt,'') + ' -Wl,--copy-dt-needed-entries -Wl,--enable-new-dtags')
 
-    
+
+    if env.get('LINKER'):
+        _setupLinker(env, opt)
+
+    if env.get('COMPILER_CACHE'):
+        _setupCompilerCache(env, comp)
+
     trace ( "Initialized psdm_cplusplus tool", "psdm_cplusplus", 2 )
 
 def exists(env):
@@ -8,7 +8,6 @@ AUTHORS:
 """
 
 import os
-import subprocess
 
 import SCons
 from SCons.Builder import Builder
@@ -16,6 +15,7 @@ from SCons.Action import Action
 
 from SConsTools.trace import *
 from SConsTools.scons_functions import *
+from SConsTools.action_stats import timedAction, call
 
 def _fmtList ( lst ):
     return '[' + ','.join(map(str, lst)) + ']'
@@ -36,7 +36,7 @@ class _pyCompile(object) :
         # we need to compile it using "standard" python which may be
         # different from python running SCons
         cmd = [env['PYTHON_BIN'], '-c', 'import py_compile; py_compile.compile("%s", "%s", doraise=True)' % (source, target)]
-        rc = subprocess.call(cmd)
+        rc = call(cmd)
         if rc != 0:
             return -1
         
@@ -50,7 +50,7 @@ def create_builder(env):
     try:
         builder = env['BUILDERS']['PyCompile']
     except KeyError:
-        builder = SCons.Builder.Builder(action = _pyCompile())
+        builder = SCons.Builder.Builder(action = timedAction(env, _pyCompile()))
         env['BUILDERS']['PyCompile'] = builder
 
     return builder
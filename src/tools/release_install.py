@@ -15,6 +15,7 @@ from SCons.Action import Action
 
 from SConsTools.trace import *
 from SConsTools.scons_functions import *
+from SConsTools.action_stats import timedAction
 
 
 def _fmtList(lst):
@@ -59,7 +60,7 @@ def create_builder(env):
     try:
         builder = env['BUILDERS']['ReleaseInstall']
     except KeyError:
-        builder = SCons.Builder.Builder(action=_makeReleaseInstall())
+        builder = SCons.Builder.Builder(action=timedAction(env, _makeReleaseInstall()))
         env['BUILDERS']['ReleaseInstall'] = builder
 
     return builder
@@ -16,6 +16,7 @@ from SCons.Action import Action
 
 from SConsTools.trace import *
 from SConsTools.scons_functions import *
+from SConsTools.action_stats import timedAction
 
 def _fmtList ( lst ):
     return '[' + ','.join(map(str, lst)) + ']'
@@ -62,7 +63,7 @@ def create_builder(env):
     try:
         builder = env['BUILDERS']['ScriptInstall']
     except KeyError:
-        builder = SCons.Builder.Builder(action = _scriptInstall())
+        builder = SCons.Builder.Builder(action = timedAction(env, _scriptInstall()))
         env['BUILDERS']['ScriptInstall'] = builder
 
     return builder
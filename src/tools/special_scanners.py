@@ -1,40 +1,171 @@
 """
 Tool which will setup a bunch of special scanners.
 """
+from __future__ import print_function
 
 import os
+import json
+import time
+import atexit
 
 from SConsTools.trace import *
+import SCons.Util
 import SCons.Scanner
+import SCons.Node.FS
 import SCons.Tool
 
 
+class _ScanStats(object):
+    """
+    Counters and timers for the include scanner: files scanned, includes
+    found, probes and hits for every include directory, scan time per
+    package, and all that aggregated per repository.
+    """
+
+    def __init__(self, sit_arch, repos):
+        self.sit_arch = sit_arch
+        # (name, absolute path) of the roots, longest first for matching
+        self.repos = sorted(repos, key=lambda r: -len(r[1]))
+        self.files = 0
+        self.includes = 0
+        self.missing = 0
+        self.time = 0.
+        self.dirs = {}
+        self.pkgs = {}
+
+    def _repo(self, path):
+        for name, root in self.repos:
+            if path == root or path.startswith(root + os.sep):
+                return name, os.path.relpath(path, root)
+        return '<other>', path
+
+    def _package(self, node):
+        repo, path = self._repo(node.get_abspath())
+        f = path.split(os.sep)
+        if len(f) > 3 and f[0] == 'build' and f[1] == self.sit_arch:
+            pkg = f[2]
+        elif len(f) > 4 and f[0] == 'arch' and f[2] == 'geninc':
+            pkg = f[3]
+        elif len(f) > 2 and f[0] == 'include':
+            pkg = f[1]
+        elif len(f) > 1 and repo != '<other>':
+            pkg = f[0]
+        else:
+            pkg = '<other>'
+        return pkg if repo == '#' else repo + ':' + pkg
+
+    def probe(self, dir, found, dt):
+        stat = self.dirs.setdefault(dir.get_abspath(), [0, 0, 0.])
+        stat[0] += 1
+        if found: stat[1] += 1
+        stat[2] += dt
+
+    def scanned(self, node, nincludes, nmissing, dt):
+        self.files += 1
+        self.includes += nincludes
+        self.missing += nmissing
+        self.time += dt
+        stat = self.pkgs.setdefault(self._package(node), [0, 0.])
+        stat[0] += 1
+        stat[1] += dt
+
+    def report(self, fileName, top=20):
+
+        repos = {}
+        for d, (probes, hits, dt) in self.dirs.items():
+            stat = repos.setdefault(self._repo(d)[0], [0, 0, 0.])
+            stat[0] += probes
+            stat[1] += hits
+            stat[2] += dt
+
+        data = dict(files=self.files, includes=self.includes, missing=self.missing, time=self.time,
+                    dirs=dict((d, dict(probes=s[0], hits=s[1], time=s[2])) for d, s in self.dirs.items()),
+                    repos=dict((r, dict(probes=s[0], hits=s[1], time=s[2])) for r, s in repos.items()),
+                    packages=dict((p, dict(files=s[0], time=s[1])) for p, s in self.pkgs.items()))
+        d = os.path.dirname(fileName)
+        if d and not os.path.isdir(d): os.makedirs(d)
+        f = open(fileName, 'w')
+        json.dump(data, f, indent=1, sort_keys=True)
+        f.close()
+
+        print("Include scanner statistics (also in %s):" % fileName)
+        print("  %d files scanned in %.2f sec, %d includes found, %d not found" %
+              (self.files, self.time, self.includes, self.missing))
+
+        def table(title, stats):
+            print("  %-60s %9s %9s %6s %8s" % (title, "probes", "hits", "hit%", "time,s"))
+            for name, (probes, hits, dt) in sorted(stats.items(), key=lambda x: -x[1][2])[:top]:
+                print("  %-60s %9d %9d %6.1f %8.3f" % (name, probes, hits, 100.*hits/probes if probes else 0., dt))
+
+        table("include directory", self.dirs)
+        table("repository", repos)
+        print("  %-60s %9s %8s" % ("package", "files", "time,s"))
+        for name, (files, dt) in sorted(self.pkgs.items(), key=lambda x: -x[1][1])[:top]:
+            print("  %-60s %9d %8.3f" % (name, files, dt))
+
+
 class CScanner(SCons.Scanner.ClassicCPP):
-    
+
+    # statistics, set by generate() when SCAN_STATS is enabled
+    stats = None
+
     def scan(self, node, path=()):
 
         if node.includes is None:
             # do not need dependencies originating from headers inside arch/$SIT_ARCH/geninc
             f = str(node).split(os.sep)
-            trace('node: %s' % f, 'CScanner.scan', 4)
+            trace('node: %s', 'CScanner.scan', 4, f)
             try:
                 aidx = f.index('arch')
                 if aidx + 3 < len(f) and f[aidx+2] == 'geninc':
                     node.includes = []
             except ValueError:
                 pass
-    
-        return super(SCons.Scanner.ClassicCPP, self).scan(node, path)
+
+        if self.stats is None:
+            return super(SCons.Scanner.ClassicCPP, self).scan(node, path)
+
+        t0 = time.time()
+        nodes = super(SCons.Scanner.ClassicCPP, self).scan(node, path)
+        self.stats.scanned(node, len(nodes), len(node.includes) - len(nodes), time.time() - t0)
+        return nodes
+
+    def find_include(self, include, source_dir, path):
+
+        if self.stats is None:
+            return super(CScanner, self).find_include(include, source_dir, path)
+
+        # same search as in ClassicCPP but one directory at a time
+        include = list(map(SCons.Util.to_str, include))
+        if include[0] == '"':
+            paths = (source_dir,) + tuple(path)
+        else:
+            paths = tuple(path) + (source_dir,)
+
+        n = None
+        for d in paths:
+            t0 = time.time()
+            n = SCons.Node.FS.find_file(include[1], (d,))
+            self.stats.probe(d, n is not None, time.time() - t0)
+            if n is not None: break
+        return n, SCons.Util.silent_intern(include[1])
 
 def generate(env):
 
-    cscanner = CScanner("CScanner", 
+    cscanner = CScanner("CScanner",
                         "$CPPSUFFIXES",
-                        "CPPPATH", 
+                        "CPPPATH",
                         '^[ \t]*#[ \t]*(?:include|import)[ \t]*(<|")([^>"]+)(>|")')
+
+    if env.get('SCAN_STATS'):
+        repos = [('#', env.Dir('#').abspath)] + [(r, os.path.abspath(r)) for r in env['SIT_REPOS']]
+        if env.get('CONDA_ENV_PATH'): repos.append(('conda', env['CONDA_ENV_PATH']))
+        cscanner.stats = _ScanStats(env['SIT_ARCH'], repos)
+        atexit.register(cscanner.stats.report, os.path.join(env.Dir('#').abspath, "build", env['SIT_ARCH'], "scan_stats.json"))
+
     for suffix in SCons.Tool.CSuffixes:
         SCons.Tool.SourceFileScanner.add_scanner(suffix, cscanner)
-    
+
     trace ( "Initialized special_scanners tool", "special_scanners", 2 )
 
 def exists(env):
@@ -15,6 +15,7 @@ from SCons.Action import Action
 
 from SConsTools.trace import *
 from SConsTools.scons_functions import *
+from SConsTools.action_stats import timedAction
 
 def _fmtList ( lst ):
     return '[' + ','.join(map(str, lst)) + ']'
@@ -62,12 +63,12 @@ def create_builders(env):
     try:
         builder = env['BUILDERS']['Symlink']
     except KeyError:
-        builder = SCons.Builder.Builder(action = _makeSymlink())
+        builder = SCons.Builder.Builder(action = timedAction(env, _makeSymlink()))
         env['BUILDERS']['Symlink'] = builder
     try:
         builder = env['BUILDERS']['SymlinkRel']
     except KeyError:
-        builder = SCons.Builder.Builder(action = _makeSymlink(True))
+        builder = SCons.Builder.Builder(action = timedAction(env, _makeSymlink(True)))
         env['BUILDERS']['SymlinkRel'] = builder
 
 def generate(env):
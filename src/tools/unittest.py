@@ -17,6 +17,7 @@ from SCons.Action import Action
 
 from SConsTools.trace import *
 from SConsTools.scons_functions import *
+from SConsTools.action_stats import timedAction, call
 
 def _fmtList ( lst ):
     return '[' + ','.join(map(str, lst)) + ']'
@@ -38,7 +39,7 @@ class _unitTest(object) :
             cmd = bin+ ' > ' + out + ' 2>&1'
             trace ( "Executing unitTest `%s'" % ( bin ), "unitTest", 3 )
             time.sleep(1)
-            ret = os.system ( cmd )
+            ret = call ( cmd, shell=True )
 
             if ret != 0 :
                 try:
@@ -71,7 +72,7 @@ def create_builder(env):
     try:
         builder = env['BUILDERS']['UnitTest']
     except KeyError:
-        builder = SCons.Builder.Builder(action = _unitTest())
+        builder = SCons.Builder.Builder(action = timedAction(env, _unitTest()))
         env['BUILDERS']['UnitTest'] = builder
 
     return builder
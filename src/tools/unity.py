@@ -0,0 +1,68 @@
+"""SCons.Tool.unity
+
+Tool-specific initialization for UnityFile builder.
+
+UnityFile builder makes a C++ file which includes a number of other source
+files so that they are compiled as a single translation unit. Source of the
+builder is a Value with the list of included files, so the file is only
+regenerated when that list changes.
+
+"""
+
+import os
+
+import SCons
+
+from SConsTools.trace import *
+from SConsTools.scons_functions import *
+from SConsTools.action_stats import timedAction
+
+def _fmtList ( lst ):
+    return '[' + ','.join(map(str, lst)) + ']'
+
+class _unityFile(object) :
+
+    def __call__ ( self, target, source, env ) :
+        """Target is a file, source is a Value with newline-separated list of included files"""
+        if len(target) != 1 :
+            fail ( "unexpected number of targets for UnityFile: "+str(target) )
+        if len(source) != 1 :
+            fail ( "unexpected number of sources for UnityFile: "+str(source) )
+
+        target = str(target[0])
+        includes = source[0].read().split('\n')
+        trace ( "Executing UnityFile `%s' -> %s" % ( target, includes ), "UnityFile", 3 )
+
+        # may need to make a directory for target
+        targetdir = os.path.dirname ( target )
+        if not os.path.isdir( targetdir ) : os.makedirs( targetdir )
+
+        f = open(target, 'w')
+        for inc in includes:
+            f.write('#include "%s"\n' % inc)
+        f.close()
+
+    def strfunction ( self, target, source, env ):
+        try :
+            return "Creating unity file: \"" + str(target[0]) + "\""
+        except :
+            return 'UnityFile('+_fmtList(target)+', '+_fmtList(source)+')'
+
+def create_builder(env):
+    try:
+        builder = env['BUILDERS']['UnityFile']
+    except KeyError:
+        builder = SCons.Builder.Builder(action = timedAction(env, _unityFile()))
+        env['BUILDERS']['UnityFile'] = builder
+
+    return builder
+
+def generate(env):
+    """Add Builders and construction variables for unity files."""
+
+    create_builder(env)
+
+    trace ( "Initialized unity tool", "unity", 2 )
+
+def exists(env):
+    return True
@@ -1,24 +1,130 @@
 #===============================================================================
 #
-# Main SCons script for SIT release building
+# Tracing and debug messages for SConsTools
 #
 # $Id$
 #
 #===============================================================================
 
+import sys
+import json
+import time
 import logging
+import threading
+import collections
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
 
+# default level and per-category (src) levels
 trace_level = 0
+_levels = {}
 
+# messages with level above this are dropped right away
+_maxLevel = 0
+
+# JSON-lines output file and in-memory ring buffer
+_file = None
+_ring = None
+_ringLevel = 0
+_lock = threading.Lock()
+
+def _updateMaxLevel():
+    global _maxLevel
+    _maxLevel = max([trace_level, _ringLevel] + list(_levels.values()))
+
+#
+# Set trace levels, level is a number or a string with optional default
+# level and per-category levels, e.g. "2,adjustPkgDeps=4,SConscript=3"
+#
 def setTraceLevel ( level ):
-    global trace_level 
-    trace_level = level
+    global trace_level
+    trace_level = 0
+    _levels.clear()
+    for item in str(level).split(','):
+        item = item.strip()
+        if not item: continue
+        if '=' in item:
+            src, lvl = item.split('=', 1)
+            _levels[src.strip()] = int(lvl)
+        else:
+            trace_level = int(item)
+    _updateMaxLevel()
+
 #
-# Print debug message
+# Write all traced messages as JSON lines into a file (in addition to log)
 #
-def trace ( msg, src, level ) :
-    #print "trace_level=", trace_level, "level=", level
-    if trace_level >= level :
+def setTraceFile ( fileName ):
+    global _file
+    with _lock:
+        if _file is not None: _file.close()
+        _file = open(fileName, 'w') if fileName else None
+
+#
+# Keep last `size` messages with level up to `level` in memory (even if
+# they are not printed), they are dumped by dumpTraceRing()
+#
+def setTraceRing ( size, level=4 ):
+    global _ring, _ringLevel
+    if size > 0:
+        _ring = collections.deque(maxlen=size)
+        _ringLevel = level
+    else:
+        _ring = None
+        _ringLevel = 0
+    _updateMaxLevel()
+
+#
+# Print messages from the ring buffer
+#
+def dumpTraceRing ( out=None ):
+    if not _ring: return
+    if out is None: out = sys.stderr
+    with _lock:
+        recs = list(_ring)
+        _ring.clear()
+    out.write("---- last %d trace messages ----\n" % len(recs))
+    for rec in recs:
+        out.write("%s {%s-%d} [%s] %s\n" % (time.strftime("%H:%M:%S", time.localtime(rec['time'])),
+                                            rec['src'], rec['level'], rec['thread'], rec['msg']))
+    out.write("---- end of trace messages ----\n")
+
+#
+# Returns True if messages for this category and level are traced, use
+# it to avoid expensive computation of the trace arguments
+#
+def traceEnabled ( src, level ) :
+    return level <= _maxLevel and (level <= _levels.get(src, trace_level) or level <= _ringLevel)
+
+#
+# Argument for trace() which formats a sequence as a list of strings only
+# when the message is actually formatted
+#
+class lazyList(object):
+
+    __slots__ = ('_seq',)
+
+    def __init__(self, seq):
+        self._seq = seq
+
+    def __str__(self):
+        return str(list(map(str, self._seq)))
+
+#
+# Print debug message, when args are given message is formatted as msg % args
+# only if it is traced
+#
+def trace ( msg, src, level, *args ) :
+    if level > _maxLevel : return
+    printed = level <= _levels.get(src, trace_level)
+    if not printed and (_ring is None or level > _ringLevel) : return
+
+    if args: msg = msg % args
+    if printed :
         logging.info( "{%s-%d}  %s" % ( src, level, msg) )
+    if _file is not None or _ring is not None :
+        rec = dict(time=time.time(), src=src, level=level, msg=msg, thread=threading.current_thread().name)
+        with _lock:
+            if _ring is not None: _ring.append(rec)
+            if printed and _file is not None:
+                _file.write(json.dumps(rec) + '\n')
+                _file.flush()